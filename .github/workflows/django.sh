@@ -18,3 +18,6 @@ black --check apps
 
 python manage.py test project
 python manage.py test apps
+
+# Query budgets of the chat pages and websocket actions on a small dataset
+python manage.py check_query_budgets --users 60 --rooms 40 --messages 60:120
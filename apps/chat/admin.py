@@ -1,8 +1,28 @@
 from django.contrib import admin
-from django.db.models import Count
+from django.contrib.auth import get_user_model
+from django.core.paginator import Paginator
+from django.db.models import Count, Sum
+from django.utils.functional import cached_property
 from django.utils.html import format_html
 
-from .models import Message, MessageReceipt, MessageStatus, Room
+from . import search
+from .budgets import QueryBudget
+from .models import Message, MessageStatus, Room, RoomWatermark
+
+User = get_user_model()
+
+
+class MessagePaginator(Paginator):
+    """
+    Counts the unfiltered message list from the denormalized
+    Room.message_count instead of scanning the messages table
+    """
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            return Room.objects.aggregate(total=Sum("message_count"))["total"] or 0
+        return super().count
 
 
 @admin.register(Room)
@@ -17,18 +37,27 @@ class RoomAdmin(admin.ModelAdmin):
     ]
     list_filter = ["chat_type", "dtm_created"]
     search_fields = ["name", "creator__username", "participants__username"]
-    readonly_fields = ["dtm_created", "dtm_updated"]
+    readonly_fields = [
+        "dtm_created",
+        "dtm_updated",
+        "last_message",
+        "last_activity",
+        "message_count",
+    ]
     filter_horizontal = ["participants"]
     date_hierarchy = "dtm_created"
+    query_budgets = {
+        "changelist": QueryBudget(queries=8),
+        "change": QueryBudget(queries=8),
+    }
 
     def get_queryset(self, request):
         return (
             super()
             .get_queryset(request)
-            .annotate(
-                message_count=Count("messages", distinct=True),
-                participant_count=Count("participants", distinct=True),
-            )
+            .annotate(participant_count=Count("participants", distinct=True))
+            # The names of private rooms are made of their participants
+            .prefetch_related("participants")
         )
 
     def name_display(self, obj):
@@ -42,12 +71,6 @@ class RoomAdmin(admin.ModelAdmin):
     participant_count.short_description = "Participants"
     participant_count.admin_order_field = "participant_count"
 
-    def message_count(self, obj):
-        return obj.message_count
-
-    message_count.short_description = "Messages"
-    message_count.admin_order_field = "message_count"
-
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
@@ -60,10 +83,27 @@ class MessageAdmin(admin.ModelAdmin):
         "dtm_created",
     ]
     list_filter = ["dtm_created", "room__chat_type"]
+    # Content through the full-text index, see get_search_results
     search_fields = ["content", "sender__username", "room__name"]
+    search_help_text = (
+        "Words of the message content, or the start of the sender's username "
+        "or the room name"
+    )
     readonly_fields = ["dtm_created", "status_display"]
-    date_hierarchy = "dtm_created"
     raw_id_fields = ["room", "sender"]
+    # Drawn from the first and last message, see
+    # templates/admin/chat/message/change_list.html
+    date_hierarchy = "dtm_created"
+    # Newest first by primary key; the default dtm_created ordering would
+    # sort the whole messages table
+    ordering = ["-id"]
+    paginator = MessagePaginator
+    show_full_result_count = False
+    query_budgets = {
+        "changelist": QueryBudget(queries=8),
+        # The room's raw id label lists the members of a private room
+        "change": QueryBudget(queries=9),
+    }
 
     def truncated_content(self, obj):
         return (obj.content[:50] + "...") if len(obj.content) > 50 else obj.content
@@ -80,6 +120,35 @@ class MessageAdmin(admin.ModelAdmin):
     room_display.short_description = "Room"
     room_display.admin_order_field = "room"
 
+    def get_queryset(self, request):
+        return (
+            super()
+            .get_queryset(request)
+            .select_related("room", "sender")
+            .prefetch_related("room__participants")
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        # LIKE '%term%' would read every message. Each kind of match is an
+        # index lookup on chat_message and their ids are combined with a
+        # UNION; an OR across the joined tables makes SQLite walk the whole
+        # table newest first looking for matches
+        ids = Message.objects.order_by().values("id")
+        senders = User.objects.filter(username__istartswith=term).values("id")
+        rooms = Room.objects.filter(name__istartswith=term).values("id")
+        matches = [ids.filter(sender_id__in=senders), ids.filter(room_id__in=rooms)]
+        if search.query_terms(term):
+            matches.insert(0, ids.filter(id__in=search.matching_ids(term)))
+        return queryset.filter(id__in=matches[0].union(*matches[1:])), False
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        Message.prefetch_statuses(changelist.result_list)
+        return changelist
+
     def status_display(self, obj):
         status = obj.get_status_display()
         status_colors = {
@@ -90,36 +159,50 @@ class MessageAdmin(admin.ModelAdmin):
         return format_html(
             '<span style="color: {}">{}</span>',
             status_colors.get(status, "black"),
-            obj.get_status_display(),
+            status,
         )
 
     status_display.short_description = "Status"
 
 
-@admin.register(MessageReceipt)
-class MessageReceiptAdmin(admin.ModelAdmin):
-    list_display = ["id", "message_display", "user", "status", "timestamp"]
-    list_filter = ["status", "timestamp"]
-    search_fields = ["message__content", "user__username", "message__room__name"]
+@admin.register(RoomWatermark)
+class RoomWatermarkAdmin(admin.ModelAdmin):
+    list_display = [
+        "id",
+        "room_display",
+        "user",
+        "last_delivered_id",
+        "last_read_id",
+        "timestamp",
+    ]
+    list_filter = ["timestamp", "room__chat_type"]
+    search_fields = ["user__username", "room__name"]
     readonly_fields = ["timestamp"]
+    raw_id_fields = ["room", "user"]
     date_hierarchy = "timestamp"
-    raw_id_fields = ["message", "user"]
+    show_full_result_count = False
+    query_budgets = {
+        # The paginator and the date hierarchy read every row: one per
+        # membership, not per message
+        "changelist": QueryBudget(queries=7, allow_scans={"chat_roomwatermark"}),
+    }
 
-    def message_display(self, obj):
+    def room_display(self, obj):
         return format_html(
             '<a href="{}">{}</a>',
-            f"/admin/chat/message/{obj.message.id}/change/",
-            obj.message.content[:50] + ("..." if len(obj.message.content) > 50 else ""),
+            f"/admin/chat/room/{obj.room.id}/change/",
+            str(obj.room),
         )
 
-    message_display.short_description = "Message"
-    message_display.admin_order_field = "message"
+    room_display.short_description = "Room"
+    room_display.admin_order_field = "room"
 
     def get_queryset(self, request):
         return (
             super()
             .get_queryset(request)
-            .select_related("message", "user", "message__room")
+            .select_related("room", "user")
+            .prefetch_related("room__participants")
         )
 
 
@@ -134,4 +217,4 @@ class ChatAdminSite(admin.AdminSite):
 # chat_admin_site = ChatAdminSite(name='chat_admin')
 # chat_admin_site.register(Room, RoomAdmin)
 # chat_admin_site.register(Message, MessageAdmin)
-# chat_admin_site.register(MessageReceipt, MessageReceiptAdmin)
+# chat_admin_site.register(RoomWatermark, RoomWatermarkAdmin)
@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class ChatConfig(AppConfig):
+    name = "apps.chat"
+    verbose_name = "Chat"
+
+    def ready(self):
+        # pylint: disable=unused-import
+        # pylint: disable=import-outside-toplevel
+        from . import signals
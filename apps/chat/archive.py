@@ -0,0 +1,282 @@
+"""
+Cold storage for old messages.
+
+``python manage.py archive_messages`` moves the messages of a room older
+than CHAT_ARCHIVE["AFTER_DAYS"] out of chat_message into compressed,
+append-only segment files:
+
+    CHAT_ARCHIVE["DIR"]/<room id>/<key of the segment's last message>.seg
+
+A room's segments are written oldest history first and never modified.
+Each holds the next stretch of the room's history in (dtm_created, id)
+order, so the key in the name of the newest segment is the room's archive
+boundary: every message up to it is in a segment, every later one in
+chat_message. Readers find the boundary by listing the room's directory,
+without a database query, and history.get_page reads across it.
+
+A segment is MAGIC, zlib-compressed JSON blocks of BLOCK_SIZE messages,
+the zlib-compressed sparse index with one entry per block (first and last
+key, lowest and highest id, offset and length), and a footer holding the
+offset and length of the index followed by MAGIC. Segments are memory
+mapped; a read bisects the index and decompresses only the blocks it
+needs.
+
+The directory has to be shared by every process serving the history.
+Archived messages are not in the search index and do not count towards
+Room.message_count or unread counts. Archived messages whose sender has
+since been deleted are skipped on reading, as the cascade would have
+removed them from the table.
+"""
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import zlib
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from .models import Message
+
+User = get_user_model()
+
+DEFAULT_ARCHIVE = {
+    "DIR": "archive",
+    "AFTER_DAYS": 180,
+}
+
+MAGIC = b"CHATSEG1"
+# Offset and length of the sparse index
+FOOTER = struct.Struct("<QQ")
+BLOCK_SIZE = 256
+SUFFIX = ".seg"
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def to_micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def row_key(row):
+    # Rows are [id, sender_id, dtm_created, dtm_updated, content], the
+    # times in microseconds since the epoch
+    return row[2], row[0]
+
+
+class Segment:
+    """A memory-mapped segment file"""
+
+    def __init__(self, path):
+        with open(path, "rb") as segment_file:
+            self.data = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[: len(MAGIC)] != MAGIC or self.data[-len(MAGIC) :] != MAGIC:
+            raise ValueError(f"{path} is not a message segment")
+        offset, length = FOOTER.unpack_from(
+            self.data, len(self.data) - len(MAGIC) - FOOTER.size
+        )
+        # [first micros, first id, last micros, last id, min id, max id,
+        #  offset, length] per block
+        self.blocks = json.loads(zlib.decompress(self.data[offset : offset + length]))
+        self.first_keys = [(block[0], block[1]) for block in self.blocks]
+
+    def rows(self, block):
+        offset, length = block[6], block[7]
+        return json.loads(zlib.decompress(self.data[offset : offset + length]))
+
+    def ascending(self, after=None):
+        """Rows with a key above `after`, oldest first"""
+        start = 0 if after is None else max(bisect_right(self.first_keys, after) - 1, 0)
+        for block in self.blocks[start:]:
+            for row in self.rows(block):
+                if after is None or row_key(row) > after:
+                    yield row
+
+    def descending(self, before=None):
+        """Rows with a key below `before`, newest first"""
+        end = (
+            len(self.blocks) if before is None else bisect_left(self.first_keys, before)
+        )
+        for block in reversed(self.blocks[:end]):
+            for row in reversed(self.rows(block)):
+                if before is None or row_key(row) < before:
+                    yield row
+
+    def find(self, message_id):
+        for block in self.blocks:
+            if block[4] <= message_id <= block[5]:
+                for row in self.rows(block):
+                    if row[0] == message_id:
+                        return row
+        return None
+
+
+@lru_cache(maxsize=256)
+def open_segment(path):
+    # Segments never change once written, so mappings can be kept open
+    return Segment(path)
+
+
+def write_segment(path, rows):
+    """Write rows in key order to a new segment file at path"""
+    blocks = []
+    temporary = path.with_suffix(".tmp")
+    with open(temporary, "wb") as segment_file:
+        segment_file.write(MAGIC)
+        offset = len(MAGIC)
+        for start in range(0, len(rows), BLOCK_SIZE):
+            block = rows[start : start + BLOCK_SIZE]
+            data = zlib.compress(json.dumps(block, separators=(",", ":")).encode())
+            segment_file.write(data)
+            ids = [row[0] for row in block]
+            blocks.append(
+                [*row_key(block[0]), *row_key(block[-1]), min(ids), max(ids)]
+                + [offset, len(data)]
+            )
+            offset += len(data)
+        index = zlib.compress(json.dumps(blocks, separators=(",", ":")).encode())
+        segment_file.write(index)
+        segment_file.write(FOOTER.pack(offset, len(index)))
+        segment_file.write(MAGIC)
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+    os.replace(temporary, path)
+    # Make the rename durable before the messages are deleted
+    directory = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class RoomArchive:
+    """The segments of one room as listed at one moment, oldest first"""
+
+    def __init__(self, room_id, paths):
+        self.room_id = room_id
+        self.paths = paths
+        # (dtm_created, id) of the newest archived message, or None
+        self.boundary = None
+        if paths:
+            micros, message_id = Path(paths[-1]).stem.split("-")
+            self.boundary = from_micros(int(micros)), int(message_id)
+
+    def __bool__(self):
+        return bool(self.paths)
+
+    def read_before(self, before=None, limit=50):
+        """Archived messages before the (dtm_created, id) key, newest first"""
+        key = None if before is None else (to_micros(before[0]), before[1])
+        rows = (
+            row
+            for path in reversed(self.paths)
+            for row in open_segment(path).descending(key)
+        )
+        return self.collect(rows, limit)
+
+    def read_after(self, after=None, limit=50):
+        """Archived messages after the (dtm_created, id) key, oldest first"""
+        key = None if after is None else (to_micros(after[0]), after[1])
+        return self.collect(self.ascending(key), limit)
+
+    def ascending(self, key):
+        for path in self.paths:
+            segment = open_segment(path)
+            if key is not None and tuple(segment.blocks[-1][2:4]) <= key:
+                continue
+            yield from segment.ascending(key)
+
+    def get(self, message_id):
+        """An archived message, or None"""
+        for path in self.paths:
+            row = open_segment(path).find(message_id)
+            if row is not None:
+                return next(iter(self.messages([row])), None)
+        return None
+
+    def collect(self, rows, limit):
+        """Messages for the first `limit` rows whose sender still exists"""
+        messages, batch = [], []
+        for row in rows:
+            batch.append(row)
+            if len(messages) + len(batch) == limit:
+                messages += self.messages(batch)
+                batch = []
+                if len(messages) == limit:
+                    return messages
+        return messages + self.messages(batch)
+
+    def messages(self, rows):
+        """Unsaved Message instances with their senders"""
+        senders = User.objects.in_bulk({row[1] for row in rows}) if rows else {}
+        messages = []
+        for message_id, sender_id, created, updated, content in rows:
+            if sender_id not in senders:
+                continue
+            message = Message(
+                id=message_id,
+                room_id=self.room_id,
+                sender=senders[sender_id],
+                content=content,
+                dtm_created=from_micros(created),
+                dtm_updated=from_micros(updated),
+            )
+            message._state.adding = False
+            messages.append(message)
+        return messages
+
+
+class Archive:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def room(self, room_id):
+        """The room's archive; empty, and false, if nothing is archived"""
+        directory = self.directory / str(room_id)
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            return RoomArchive(room_id, [])
+        with entries:
+            names = sorted(
+                entry.name for entry in entries if entry.name.endswith(SUFFIX)
+            )
+        return RoomArchive(room_id, [str(directory / name) for name in names])
+
+    def append(self, room_id, messages):
+        """
+        Write (id, sender_id, dtm_created, dtm_updated, content) tuples,
+        which must follow the room's boundary in key order, as its newest
+        segment; returns the new boundary
+        """
+        rows = [
+            [message_id, sender_id, to_micros(created), to_micros(updated), content]
+            for message_id, sender_id, created, updated, content in messages
+        ]
+        micros, message_id = row_key(rows[-1])
+        directory = self.directory / str(room_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        # Zero-padded so that names sort in key order
+        write_segment(directory / f"{micros:020d}-{message_id:020d}{SUFFIX}", rows)
+        return from_micros(micros), message_id
+
+    def delete_room(self, room_id):
+        shutil.rmtree(self.directory / str(room_id), ignore_errors=True)
+
+
+@lru_cache
+def get_archive():
+    """Return the process-wide message archive configured in settings"""
+    config = {**DEFAULT_ARCHIVE, **getattr(settings, "CHAT_ARCHIVE", {})}
+    return Archive(config["DIR"])
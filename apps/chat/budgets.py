@@ -0,0 +1,202 @@
+"""
+Query budgets for the chat views, admin pages and websocket actions.
+
+Budgets are declared next to the code they cover, as ``query_budget`` on
+views and ``query_budgets`` (keyed by page or action) on admin classes and
+consumers:
+
+    class RoomListView(AsyncLoginRequiredMixin, View):
+        query_budget = QueryBudget(queries=4)
+
+``python manage.py check_query_budgets`` generates a dataset in a test
+database, requests every covered page, drives every websocket action and
+fails when one of them runs more queries than its budget, spends more
+than its time_ms in the database, or has a query whose plan is a full
+scan of one of the SCAN_CHECKED_TABLES.
+"""
+
+import json
+import re
+import time
+
+from django.db import connection
+
+from .models import Message, RoomEvent, RoomWatermark
+
+# Tables that grow with the message volume and must never be scanned
+SCAN_CHECKED_TABLES = {
+    Message._meta.db_table,
+    RoomWatermark._meta.db_table,
+    RoomEvent._meta.db_table,
+}
+
+
+# Not counted against budgets; which of them are sent depends on the backend
+TRANSACTION_CONTROL = re.compile(
+    r"\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b", re.IGNORECASE
+)
+
+
+def statements(queries):
+    """The recorded queries without transaction control"""
+    return [query for query in queries if not TRANSACTION_CONTROL.match(query["sql"])]
+
+
+class QueryBudget:
+    def __init__(self, queries, time_ms=None, allow_scans=()):
+        self.queries = queries
+        self.time_ms = time_ms
+        # Tables a page is allowed to scan, e.g. for the admin's row counts
+        self.allow_scans = set(allow_scans)
+
+    def violations(self, queries):
+        """Why the recorded queries break the budget; empty if they don't"""
+        problems = []
+        count = len(statements(queries))
+        if count > self.queries:
+            problems.append(f"{count} queries, budget {self.queries}")
+        total_ms = sum(query["time"] for query in queries) * 1e3
+        if self.time_ms is not None and total_ms > self.time_ms:
+            problems.append(f"{total_ms:.1f} ms in queries, budget {self.time_ms} ms")
+        for query in queries:
+            for table in query.get("scans", set()) - self.allow_scans:
+                problems.append(f"full scan of {table}: {query['sql'][:120]}")
+        return problems
+
+
+class QueryRecorder:
+    """execute_wrapper recording the SQL, parameters and time of queries"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(
+                {
+                    "sql": sql,
+                    "params": params,
+                    "many": many,
+                    "time": time.perf_counter() - start,
+                }
+            )
+
+    def take(self):
+        """The queries recorded since the last call"""
+        queries, self.queries = self.queries, []
+        return queries
+
+
+def explain(query):
+    """
+    Add the plan of a recorded query and the SCAN_CHECKED_TABLES it scans
+    in full. Only reads and the WHERE clauses of writes have plans worth
+    checking; inserts and transaction control are skipped.
+    """
+    sql = query["sql"]
+    query["plan"], query["scans"] = [], set()
+    if query["many"] or not re.match(r"\s*(SELECT|UPDATE|DELETE|WITH)\b", sql, re.I):
+        return query
+
+    explainer = {
+        "sqlite": explain_sqlite,
+        "postgresql": explain_postgresql,
+        "mysql": explain_mysql,
+    }.get(connection.vendor)
+    if explainer is not None:
+        with connection.cursor() as cursor:
+            query["plan"], scanned = explainer(cursor, sql, query["params"])
+        query["scans"] = scanned & SCAN_CHECKED_TABLES
+    return query
+
+
+def explain_sqlite(cursor, sql, params):
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    plan = [row[-1] for row in cursor.fetchall()]
+    # Subqueries and joins refer to their tables by alias: "chat_message" U0
+    aliases = dict(
+        (alias, table) for table, alias in re.findall(r'"(\w+)" ([A-Z]\d+)\b', sql)
+    )
+    # A LIMIT ends a scan early only if the rows need no sorting first and
+    # the scan does not have to read past rows the WHERE throws away: the
+    # query has no WHERE (the newest rows by id, other tables being joined
+    # by lookups), or every column the WHERE tests is in the index the
+    # scan follows.
+    limited = re.search(r"\bLIMIT\b", sql) and not any(
+        "TEMP B-TREE" in line for line in plan
+    )
+    filtered = re.search(r"\bWHERE\b", sql)
+    scans = sum(line.startswith("SCAN ") for line in plan)
+    scanned = set()
+    for line in plan:
+        match = re.match(r"SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?", line)
+        if match is None:
+            continue
+        name, index = match.groups()
+        if limited and not filtered and (index or scans == 1):
+            continue
+        if (
+            limited
+            and index
+            and where_columns(sql) <= index_columns(cursor, name, index)
+        ):
+            continue
+        scanned.add(aliases.get(name, name))
+    return plan, scanned
+
+
+def where_columns(sql):
+    """(table or alias, column) pairs tested in the WHERE clauses of sql"""
+    columns = set()
+    for clause in re.findall(
+        r"\bWHERE\b(.*?)(?=\bORDER BY\b|\bGROUP BY\b|\bLIMIT\b|$)", sql, re.S
+    ):
+        for table, alias, column in re.findall(
+            r'(?:"(\w+)"|\b([A-Z]\d+))\."(\w+)"', clause
+        ):
+            columns.add((table or alias, column))
+    return columns
+
+
+def index_columns(cursor, name, index):
+    """Columns of an SQLite index, rowid included, as (name, column) pairs"""
+    cursor.execute(f'PRAGMA index_info("{index}")')
+    return {(name, row[2]) for row in cursor.fetchall()} | {(name, "id")}
+
+
+def explain_postgresql(cursor, sql, params):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    result = cursor.fetchone()[0]
+    if isinstance(result, str):
+        result = json.loads(result)
+    plan, scanned = [], set()
+
+    def walk(node, depth):
+        relation = node.get("Relation Name")
+        plan.append(
+            "  " * depth + node["Node Type"] + (f" on {relation}" if relation else "")
+        )
+        if node["Node Type"] == "Seq Scan":
+            scanned.add(relation)
+        for child in node.get("Plans", []):
+            walk(child, depth + 1)
+
+    walk(result[0]["Plan"], 0)
+    return plan, scanned
+
+
+def explain_mysql(cursor, sql, params):
+    cursor.execute("EXPLAIN " + sql, params)
+    columns = [column[0] for column in cursor.description]
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    aliases = dict(
+        (alias, table) for table, alias in re.findall(r"`(\w+)` ([A-Z]\d+)\b", sql)
+    )
+    plan = [f"{row['table']}: {row['type']} {row['key'] or ''}" for row in rows]
+    scanned = {
+        aliases.get(row["table"], row["table"]) for row in rows if row["type"] == "ALL"
+    }
+    return plan, scanned
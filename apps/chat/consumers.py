@@ -1,188 +1,405 @@
-import json
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-
-from .models import Message, MessageReceipt, MessageStatus, Room
-
-
-class ChatConsumer(AsyncWebsocketConsumer):
-    # Store connected users and their room connections
-    connected_users = {}
+from django.db import DatabaseError
+
+from . import history, metrics
+from .budgets import QueryBudget
+from .frames import dumps, group_event, loads
+from .layers import group_send_many
+from .models import MessageStatus, Room, RoomWatermark
+from .persistence import get_persistence
+from .presence import get_presence
+from .profiling import get_profiler
+from .receipts import get_receipts
+
+logger = logging.getLogger(__name__)
+
+# Close code sent to clients that were disconnected for falling behind
+OVERFLOW_CLOSE_CODE = 4008
+
+# Frame types counted by name in the metrics; anything else is "other"
+FRAME_TYPES = {"subscribe", "unsubscribe", "message", "ack", "status_update"}
+
+
+class InvalidFrame(ValueError):
+    """A client frame with a missing or malformed field"""
+
+
+def frame_id(data, key, required=True):
+    """The integer id in a frame field; None if optional and absent"""
+    value = data.get(key)
+    if value is None and not required:
+        return None
+    # bool is an int subclass; "true" is not an id
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise InvalidFrame(key)
+    try:
+        return int(value)
+    except ValueError:
+        raise InvalidFrame(key) from None
+
+
+class MultiplexConsumer(AsyncWebsocketConsumer):
+    """
+    One websocket per user for any number of rooms plus notifications.
+
+    Clients send {"type": "subscribe"|"unsubscribe", "room_id": ...} to
+    join and leave rooms, and tag message/ack frames with the room_id they
+    are meant for. Every room frame sent by the server carries its room_id.
+    """
+
+    # Whether the connection receives the user's notifications
+    notifications = True
+    # Per action, with the default in-memory presence backend and another
+    # member of the room online, whose delivery watermark a message moves
+    query_budgets = {
+        "connect": QueryBudget(queries=2),
+        "subscribe": QueryBudget(queries=8),
+        "message": QueryBudget(queries=5),
+        "ack": QueryBudget(queries=6),
+        "disconnect": QueryBudget(queries=0),
+    }
 
     async def connect(self):
-        self.room_id = self.scope["url_route"]["kwargs"]["room_name"]
-        self.room_group_name = f"chat_{self.room_id}"
         self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.presence = get_presence()
+        self.persistence = get_persistence()
+        self.receipts = get_receipts()
+        self.profiler = get_profiler()
+        self.background_tasks = set()
+        # room id -> Room with the cached room_name and participant_ids
+        self.rooms = {}
+        self.notification_group_name = f"notifications_{self.user.id}"
 
-        # Store user's connection
-        if self.user.id not in self.connected_users:
-            self.connected_users[self.user.id] = set()
-        self.connected_users[self.user.id].add(self.room_id)
+        # Keep the presence entries of subscribed rooms alive
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
 
-        # Join room group
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        if self.notifications:
+            await self.channel_layer.group_add(
+                self.notification_group_name, self.channel_name
+            )
         await self.accept()
-
-        # Mark undelivered messages as delivered for this user in this room
-        await self.mark_messages_as_delivered()
+        metrics.CONNECTIONS_OPENED.inc(type(self).__name__)
+        metrics.CONNECTIONS_ACTIVE.inc(type(self).__name__)
 
     async def disconnect(self, close_code):
-        # Remove user's connection
-        if self.user.id in self.connected_users:
-            self.connected_users[self.user.id].discard(self.room_id)
-            if not self.connected_users[self.user.id]:
-                del self.connected_users[self.user.id]
+        if not self.user.is_authenticated:
+            return
+        metrics.CONNECTIONS_CLOSED.inc(type(self).__name__)
+        metrics.CONNECTIONS_ACTIVE.dec(type(self).__name__)
+        self.heartbeat_task.cancel()
+        for room_id in list(self.rooms):
+            await self.unsubscribe(room_id)
+        if self.notifications:
+            await self.channel_layer.group_discard(
+                self.notification_group_name, self.channel_name
+            )
 
-        # Leave room group
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+    async def heartbeat(self):
+        """Refresh the presence entries before their TTL runs out"""
+        while True:
+            await asyncio.sleep(self.presence.ttl / 2)
+            await self.update_presence(self.presence.heartbeat, list(self.rooms))
 
     @database_sync_to_async
-    def mark_messages_as_delivered(self):
-        """Mark all undelivered messages as delivered when user connects"""
-        room = Room.objects.get(id=self.room_id)
-        # Get messages that are sent but not delivered/read
-        undelivered_messages = Message.objects.filter(
-            room=room,
-            receipts__user=self.user,
-            receipts__status=MessageStatus.SENT,
-        ).exclude(sender=self.user)
-
-        for message in undelivered_messages:
-            message.mark_as_delivered(self.user)
+    def update_presence(self, action, room_ids):
+        for room_id in room_ids:
+            action(room_id, self.user.id, self.channel_name)
+
+    def get_room(self, room_id):
+        """
+        The room with its display name and participant ids cached; None if
+        it does not exist or the user is not a participant
+        """
+        room = Room.objects.prefetch_related("participants").filter(id=room_id).first()
+        if room is None:
+            return None
+        room.room_name = room.get_room_name()
+        room.participant_ids = {user.id for user in room.participants.all()}
+        if self.user.id not in room.participant_ids:
+            return None
+        return room
+
+    async def subscribe(self, room_id, since=None):
+        """
+        Join a room; with `since`, the id of the last message the client
+        has, the messages and status changes it missed are replayed
+        """
+        if room_id in self.rooms:
+            return True
+        # Joined before the catch-up reads so that nothing broadcast in the
+        # meantime is missed; messages broadcast while the replay is built
+        # may arrive twice. Frames of the room are dropped until it is in
+        # self.rooms, and for good if the user may not join.
+        group = f"chat_{room_id}"
+        await self.channel_layer.group_add(group, self.channel_name)
+        started = time.perf_counter()
+        room, page = await self.join_room(room_id, since)
+        metrics.FRAME_DB_TIME.observe(time.perf_counter() - started, "subscribe")
+        if room is None:
+            await self.channel_layer.group_discard(group, self.channel_name)
+            await self.send_error("not_allowed", room_id)
+            return False
+
+        self.rooms[room_id] = room
+        if page is not None:
+            await self.send(
+                text_data=dumps({"type": "replay", "room_id": room.id, **page})
+            )
+        self.receipts.schedule(self.channel_layer, room.id)
+        return True
 
     @database_sync_to_async
-    def save_message(self, message):
-        room = Room.objects.get(id=self.room_id)
-        msg = Message.objects.create(room=room, sender=self.user, content=message)
-
-        # Create MessageReceipt with SENT status for all other participants
-        other_participants = room.participants.exclude(id=self.user.id)
-        MessageReceipt.objects.bulk_create(
-            [
-                MessageReceipt(message=msg, user=participant, status=MessageStatus.SENT)
-                for participant in other_participants
-            ]
+    def join_room(self, room_id, since):
+        """
+        Load the room, register the connection in its presence and catch
+        up, in one thread-pool hop. Returns the room and, with `since`, the
+        page of what was missed after that message; (None, None) if the
+        user may not join. Everything up to now is marked delivered.
+        """
+        room = self.get_room(room_id)
+        if room is None:
+            return None, None
+        # Registered before reading so that no message misses the delivery mark
+        self.presence.connect(room_id, self.user.id, self.channel_name)
+        page = history.replay(room.id, self.user, since) if since else None
+        # Just loaded from the room, so it needs no clamping
+        RoomWatermark.advance(
+            room.id, [self.user.id], delivered=room.last_message_id or 0
+        )
+        return room, page
+
+    async def unsubscribe(self, room_id):
+        if self.rooms.pop(room_id, None) is None:
+            return
+        await self.update_presence(self.presence.disconnect, [room_id])
+        await self.channel_layer.group_discard(f"chat_{room_id}", self.channel_name)
+
+    async def room_changed(self, event):
+        """Room or membership changed; refresh the cached metadata"""
+        room_id = event["room_id"]
+        if room_id not in self.rooms:
+            return
+        room = await database_sync_to_async(self.get_room)(room_id)
+        if room is None:
+            # The user was removed from the room
+            await self.unsubscribe(room_id)
+        else:
+            self.rooms[room_id] = room
+
+    def frame_room(self, data):
+        """The subscribed room a client frame is addressed to, if any"""
+        try:
+            return self.rooms.get(int(data.get("room_id")))
+        except (TypeError, ValueError):
+            return None
+
+    async def save_message(self, room, message):
+        """Persist a message; returns once it is committed"""
+        return await self.persistence.save(
+            room.id,
+            self.user.id,
+            message,
+            self.presence,
+            room.participant_ids - {self.user.id},
         )
-
-        # Update to DELIVERED for online participants
-        for participant in other_participants:
-            if (
-                participant.id in self.connected_users
-                and self.room_id in self.connected_users[participant.id]
-            ):
-                msg.mark_as_delivered(participant)
-
-        return msg
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
+        received = time.perf_counter()
+        try:
+            data = loads(text_data)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            metrics.FRAMES_RECEIVED.inc("other")
+            await self.send_error("invalid_frame", None)
+            return
         message_type = data.get("type", "message")
+        metrics.FRAMES_RECEIVED.inc(
+            message_type if message_type in FRAME_TYPES else "other"
+        )
+
+        path = self.scope["path"]
+        rules = self.profiler and self.profiler.rules(path)
+        if not rules:
+            await self.handle_frame(data, message_type, received)
+            return
+        label = f"WS {path} {message_type}"
+        with self.profiler.start(rules, self.user.get_username(), label):
+            await self.handle_frame(data, message_type, received)
+
+    async def handle_frame(self, data, message_type, received):
+        try:
+            await self.dispatch_frame(data, message_type, received)
+        except InvalidFrame as exc:
+            # Answered like the other errors, leaving the socket and the
+            # other subscriptions alone
+            await self.send_error("invalid_frame", data.get("room_id"), field=str(exc))
+
+    async def dispatch_frame(self, data, message_type, received):
+        if message_type == "subscribe":
+            await self.subscribe(
+                frame_id(data, "room_id"), since=frame_id(data, "since", required=False)
+            )
+            return
+        if message_type == "unsubscribe":
+            await self.unsubscribe(frame_id(data, "room_id"))
+            return
+
+        room = self.frame_room(data)
+        if room is None:
+            await self.send_error("not_subscribed", data.get("room_id"))
+            return
 
         if message_type == "message":
-            message = data["message"]
-            saved_message = await self.save_message(message)
+            message = data.get("message")
+            if not isinstance(message, str):
+                raise InvalidFrame("message")
+            started = time.perf_counter()
+            try:
+                saved_message = await self.save_message(room, message)
+            except Exception as exc:
+                # Nothing was stored or broadcast; the client may resend. A
+                # failed write-behind batch passes on whatever it raised,
+                # and no error may close the socket of every room
+                if not isinstance(exc, DatabaseError):
+                    logger.exception("Saving a message to room %s failed", room.id)
+                await self.send_error(
+                    "message_not_saved", room.id, client_id=data.get("client_id")
+                )
+                return
+            finally:
+                metrics.FRAME_DB_TIME.observe(time.perf_counter() - started, "message")
 
             # Broadcast message to room group
-            message_data = {
-                "type": "chat_message",
-                "message": message,
-                "message_id": saved_message.id,
-                "sender_id": self.user.id,
-                "sender_name": self.user.username,
-                "timestamp": saved_message.dtm_created.isoformat(),
-            }
-            await self.channel_layer.group_send(self.room_group_name, message_data)
+            message_data = group_event(
+                "chat_message",
+                room_id=room.id,
+                message=message,
+                message_id=saved_message.id,
+                sender_id=self.user.id,
+                sender_name=self.user.username,
+                timestamp=saved_message.dtm_created.isoformat(),
+                client_id=data.get("client_id"),
+            )
+            started = time.perf_counter()
+            await self.channel_layer.group_send(f"chat_{room.id}", message_data)
+            sent = time.perf_counter()
+            metrics.LAYER_SEND_LATENCY.observe(sent - started, "chat_message")
+            metrics.BROADCAST_LATENCY.observe(sent - received)
+            metrics.FANOUT.observe(len(room.participant_ids), "chat_message")
 
             # Send notification to all participants except sender
-            room = await self.get_room()
-            room_name = await self.get_room_name()
-            notification_data = {
-                "type": "notify_message",
-                "room_id": self.room_id,
-                "room_name": room_name,
-                "message": message[:50] + "..." if len(message) > 50 else message,
-                "sender_name": self.user.username,
-                "timestamp": saved_message.dtm_created.isoformat(),
-            }
-
-            for participant in await self.get_participants():
-                if participant.id != self.user.id:
-                    await self.channel_layer.group_send(
-                        f"notifications_{participant.id}", notification_data
-                    )
+            notification_data = group_event(
+                "notify_message",
+                room_id=room.id,
+                room_name=room.room_name,
+                message=message[:50] + "..." if len(message) > 50 else message,
+                sender_name=self.user.username,
+                timestamp=saved_message.dtm_created.isoformat(),
+            )
+
+            # Fan out in the background so the next frame is not held up
+            groups = [
+                f"notifications_{participant_id}"
+                for participant_id in room.participant_ids
+                if participant_id != self.user.id
+            ]
+            metrics.FANOUT.observe(len(groups), "notify_message")
+            self.send_in_background(
+                group_send_many(self.channel_layer, groups, notification_data)
+            )
+        elif message_type == "ack":
+            # Delivered and/or read up to the given message ids
+            await self.acknowledge(
+                room,
+                delivered=frame_id(data, "delivered", required=False),
+                read=frame_id(data, "read", required=False),
+            )
         elif message_type == "status_update":
-            message_id = data["message_id"]
-            status = data["status"]
-
-            # Update message status
-            await self.update_message_status(message_id, status)
-
-            # Broadcast status update
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "status_update",
-                    "message_id": message_id,
-                    "status": status,
-                    "user_id": self.user.id,
-                },
+            # Older clients acknowledge one message at a time
+            if data.get("status") == MessageStatus.READ:
+                await self.acknowledge(room, read=frame_id(data, "message_id"))
+            elif data.get("status") == MessageStatus.DELIVERED:
+                await self.acknowledge(room, delivered=frame_id(data, "message_id"))
+
+    async def send_error(self, error, room_id, **extra):
+        await self.send(
+            text_data=dumps(
+                {"type": "error", "error": error, "room_id": room_id, **extra}
             )
+        )
+
+    def send_in_background(self, coroutine):
+        """Run a channel layer send without blocking the receive loop"""
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def acknowledge(self, room, delivered=None, read=None):
+        """Advance this user's watermarks and schedule a status broadcast"""
+        started = time.perf_counter()
+        await database_sync_to_async(RoomWatermark.advance)(
+            room.id, [self.user.id], delivered=delivered, read=read, clamp=True
+        )
+        metrics.FRAME_DB_TIME.observe(time.perf_counter() - started, "ack")
+        self.receipts.schedule(self.channel_layer, room.id)
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        if event.get("room_id") in self.rooms:
+            await self.send(text_data=event["text"])
 
     async def status_update(self, event):
-        await self.send(text_data=json.dumps(event))
+        if event.get("room_id") in self.rooms:
+            await self.send(text_data=event["text"])
 
-    @database_sync_to_async
-    def update_message_status(self, message_id, status):
-        """Update message status for the current user"""
-        try:
-            message = Message.objects.get(id=message_id)
-            # Only update status if the user is a recipient (not the sender)
-            if message.sender != self.user:
-                if status == MessageStatus.READ:
-                    message.mark_as_read(self.user)
-                elif status == MessageStatus.DELIVERED:
-                    message.mark_as_delivered(self.user)
-        except Message.DoesNotExist:
-            pass
+    async def notify_message(self, event):
+        """Send message notification to WebSocket"""
+        await self.send(text_data=event["text"])
 
-    @database_sync_to_async
-    def get_room(self):
-        return Room.objects.get(id=self.room_id)
+    async def layer_overflow(self, event):
+        """The channel layer gave up on this connection for falling behind"""
+        await self.close(code=OVERFLOW_CLOSE_CODE)
 
-    @database_sync_to_async
-    def get_room_name(self):
-        """Get room name asynchronously"""
-        room = Room.objects.get(id=self.room_id)
-        return room.get_room_name()
 
-    @database_sync_to_async
-    def get_participants(self):
-        """Get room participants asynchronously"""
-        room = Room.objects.get(id=self.room_id)
-        return list(room.participants.all())
+class ChatConsumer(MultiplexConsumer):
+    """
+    Compatibility endpoint for ws/chat/<room>/: subscribed to that room
+    only, and frames without a room_id are meant for it
+    """
 
+    notifications = False
 
-class ChatNotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.user = self.scope["user"]
-        self.notification_group_name = f"notifications_{self.user.id}"
-
-        # Join notification group
-        await self.channel_layer.group_add(
-            self.notification_group_name, self.channel_name
-        )
-        await self.accept()
+        await super().connect()
+        if self.user.is_authenticated:
+            since = parse_qs(self.scope["query_string"].decode()).get("since")
+            try:
+                room_id = int(self.scope["url_route"]["kwargs"]["room_name"])
+                since = int(since[0]) if since else None
+            except ValueError:
+                await self.close()
+                return
+            if not await self.subscribe(room_id, since=since):
+                await self.close()
+
+    def frame_room(self, data):
+        if "room_id" not in data:
+            return next(iter(self.rooms.values()), None)
+        return super().frame_room(data)
+
+
+class ChatNotificationConsumer(MultiplexConsumer):
+    """Compatibility endpoint for ws/notifications/: notifications only"""
 
-    async def disconnect(self, close_code):
-        # Leave notification group
-        await self.channel_layer.group_discard(
-            self.notification_group_name, self.channel_name
-        )
-
-    async def notify_message(self, event):
-        """Send message notification to WebSocket"""
-        await self.send(text_data=json.dumps(event))
+    async def receive(self, text_data):
+        pass
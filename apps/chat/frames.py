@@ -0,0 +1,35 @@
+"""
+Websocket frame encoding.
+
+Group events carry the outbound frame already encoded under "text", so a
+broadcast is serialized once by the sender instead of once per recipient.
+orjson is used when it is installed.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def group_event(event_type, **payload):
+    """Build a channel layer event carrying a pre-encoded frame"""
+    event = {"type": event_type, "text": dumps({"type": event_type, **payload})}
+    if "room_id" in payload:
+        # Lets consumers drop the frames of rooms they have not joined
+        event["room_id"] = payload["room_id"]
+    return event
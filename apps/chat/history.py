@@ -0,0 +1,159 @@
+"""
+Keyset pagination over a room's message history.
+
+Pages are addressed by opaque cursors encoding (dtm_created, id) of the
+boundary message, so fetching any page is an index range scan on
+chat_message_history regardless of how deep into the history it is.
+Messages moved to cold storage (see archive.py) are read from the room's
+segments when a page reaches past its archive boundary.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Q
+
+from .archive import get_archive
+from .models import Message, RoomWatermark
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(message):
+    value = f"{message.dtm_created.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return (dtm_created, id); raises ValueError for a malformed cursor"""
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, message_id = value.split("|")
+        dtm_created = datetime.fromisoformat(timestamp)
+        message_id = int(message_id)
+    except (TypeError, UnicodeDecodeError, binascii.Error) as exc:
+        raise ValueError("Invalid cursor") from exc
+    # encode_cursor writes aware times; a naive one cannot be compared
+    # with the archive's
+    if dtm_created.tzinfo is None:
+        raise ValueError("Invalid cursor")
+    return dtm_created, message_id
+
+
+def after_key(messages, key):
+    dtm_created, message_id = key
+    # The plain range bound lets the database seek into the index
+    return messages.filter(dtm_created__gte=dtm_created).filter(
+        Q(dtm_created__gt=dtm_created) | Q(id__gt=message_id)
+    )
+
+
+def before_key(messages, key):
+    dtm_created, message_id = key
+    return messages.filter(dtm_created__lte=dtm_created).filter(
+        Q(dtm_created__lt=dtm_created) | Q(id__lt=message_id)
+    )
+
+
+def live_messages(room_id, archived):
+    """The room's messages in the table, which all follow its archive"""
+    messages = Message.objects.filter(room_id=room_id).select_related("sender")
+    if archived:
+        # Rows up to the boundary are read from the archive; any left in
+        # the table are from an interrupted archival run
+        messages = after_key(messages, archived.boundary)
+    return messages
+
+
+def get_page(room_id, before=None, after=None, limit=PAGE_SIZE):
+    """
+    Return (messages, has_more) for a room in ascending order.
+
+    With `after` the page holds the messages following that cursor,
+    otherwise the newest messages (before the `before` cursor, if given).
+    has_more tells whether further messages exist in the paging direction.
+    Pages continue from the table into the room's archive and back.
+    """
+    if after is not None:
+        return read_after(room_id, decode_cursor(after), limit)
+
+    key = None if before is None else decode_cursor(before)
+    archived = get_archive().room(room_id)
+    messages = live_messages(room_id, archived)
+    if key is not None:
+        messages = before_key(messages, key)
+    page = list(messages.order_by("-dtm_created", "-id")[: limit + 1])
+    if len(page) <= limit and archived:
+        page += archived.read_before(key, limit + 1 - len(page))
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    return page, has_more
+
+
+def read_after(room_id, key=None, limit=PAGE_SIZE):
+    """
+    Return (messages, has_more) for the messages following the
+    (dtm_created, id) key, or from the start of the history without one
+    """
+    archived = get_archive().room(room_id)
+    page = []
+    if archived and (key is None or key < archived.boundary):
+        page = archived.read_after(key, limit + 1)
+    if len(page) <= limit:
+        messages = live_messages(room_id, archived)
+        if key is not None:
+            messages = after_key(messages, key)
+        page += messages.order_by("dtm_created", "id")[: limit + 1 - len(page)]
+    return page[:limit], len(page) > limit
+
+
+def serialize_message(message):
+    return {
+        "message_id": message.id,
+        "message": message.content,
+        "sender_id": message.sender_id,
+        "sender_name": message.sender.username,
+        "timestamp": message.dtm_created.isoformat(),
+    }
+
+
+def serialize_page(room_id, user, messages, has_more):
+    """JSON-ready page; status is included for the user's own messages"""
+    floor = RoomWatermark.floor(room_id, exclude_user_id=user.id)
+    return {
+        "messages": [
+            {
+                **serialize_message(message),
+                "status": (
+                    RoomWatermark.floor_status(floor, message.id)
+                    if message.sender_id == user.id
+                    else None
+                ),
+            }
+            for message in messages
+        ],
+        "before": encode_cursor(messages[0]) if messages else None,
+        "after": encode_cursor(messages[-1]) if messages else None,
+        "has_more": has_more,
+    }
+
+
+def replay(room_id, user, since, limit=MAX_PAGE_SIZE):
+    """
+    Messages after the message with id `since` and the current watermarks,
+    for a client resuming after a reconnect; None if `since` is unknown
+    """
+    last_seen = Message.objects.filter(room_id=room_id, id=since).first()
+    if last_seen is None:
+        last_seen = get_archive().room(room_id).get(since)
+    if last_seen is None:
+        return None
+    messages, has_more = read_after(
+        room_id, (last_seen.dtm_created, last_seen.id), limit=limit
+    )
+    page = serialize_page(room_id, user, messages, has_more)
+    page["watermarks"] = RoomWatermark.lowest(RoomWatermark.for_room(room_id))
+    return page
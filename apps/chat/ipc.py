@@ -0,0 +1,251 @@
+"""
+Multi-process channel layer for one host.
+
+IPCChannelLayer lets several daphne processes on the same machine share
+groups without an external broker. Each process keeps ChatChannelLayer's
+local buffers for its own connections and listens on a Unix domain socket
+in a shared directory; the sockets present in that directory are the set
+of live workers.
+
+- send() to a channel owned by another worker is forwarded to that worker
+  only (the owner's id is part of the channel name);
+- group_send() delivers to local members and forwards one frame to every
+  peer, which delivers to its own members;
+- frames from one worker to another travel over a single stream, so a
+  sender's messages arrive in the order they were sent.
+
+Messages must be JSON-serializable. Sockets left behind by dead workers are
+removed the first time a peer fails to connect to them.
+
+Every socket in the directory is trusted, so the directory has to be
+private to the user running the workers: it is created with mode 0700, and
+a worker refuses to start if it is owned by another user or if group or
+others have any access to it.
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "apps.chat.ipc.IPCChannelLayer",
+            "CONFIG": {"path": "/run/rtm_chat/layer"},
+        }
+    }
+"""
+
+import asyncio
+import atexit
+import os
+import random
+import stat
+import string
+import time
+from contextlib import suppress
+
+from channels.exceptions import ChannelFull
+
+from .frames import dumps, loads
+from .layers import ChatChannelLayer
+
+HEADER_SIZE = 4
+
+
+class IPCChannelLayer(ChatChannelLayer):
+    def __init__(self, path=None, discovery_interval=1.0, **kwargs):
+        super().__init__(**kwargs)
+        if not path:
+            raise ValueError("IPCChannelLayer needs a socket directory (path)")
+        self.path = path
+        self.check_directory()
+        suffix = "".join(random.choice(string.ascii_lowercase) for _ in range(6))
+        self.worker_id = f"w{os.getpid()}{suffix}"
+        self.socket_path = self.peer_path(self.worker_id)
+        self.discovery_interval = discovery_interval
+        self.server = None
+        self.peer_ids = []
+        self.peers_checked = 0
+        self.loop = None
+        self.peer_writers = set()
+        # worker id -> task resolving to a StreamWriter
+        self.connections = {}
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific."):
+        await self.ensure_server()
+        suffix = "".join(random.choice(string.ascii_letters) for _ in range(12))
+        return f"{prefix}.{self.worker_id}!{suffix}"
+
+    async def receive(self, channel):
+        await self.ensure_server()
+        return await super().receive(channel)
+
+    async def send(self, channel, message):
+        owner = self.owner(channel)
+        if owner is None or owner == self.worker_id:
+            await super().send(channel, message)
+            return
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await self.forward([owner], ["send", channel, message])
+
+    async def group_send(self, group, message):
+        await super().group_send(group, message)
+        await self.forward(self.peers(), ["group", group, message])
+
+    async def group_send_many(self, groups, message):
+        groups = list(groups)
+        await super().group_send_many(groups, message)
+        await self.forward(self.peers(), ["groups", groups, message])
+
+    async def close(self):
+        for task in self.connections.values():
+            if task.done() and task.result() is not None:
+                task.result().close()
+        self.connections = {}
+        if self.server is not None and self.server.done():
+            self.server.result().close()
+        # Closing the incoming connections ends their handlers with EOF
+        for writer in list(self.peer_writers):
+            writer.close()
+        await asyncio.sleep(0)
+        self.remove_socket()
+
+    # Server side
+
+    async def ensure_server(self):
+        if self.server is None:
+            self.server = asyncio.ensure_future(self.start_server())
+        await self.server
+
+    async def start_server(self):
+        self.check_directory()
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_unix_server(
+            self.handle_peer, path=self.socket_path
+        )
+        atexit.register(self.remove_socket)
+        return server
+
+    def check_directory(self):
+        """Create the socket directory, or make sure nobody else can use it"""
+        with suppress(FileExistsError):
+            os.makedirs(self.path, mode=0o700)
+        info = os.lstat(self.path)
+        if not stat.S_ISDIR(info.st_mode):
+            raise PermissionError(f"{self.path} is not a directory")
+        if info.st_uid != os.getuid():
+            raise PermissionError(f"{self.path} is owned by another user")
+        if info.st_mode & 0o077:
+            raise PermissionError(
+                f"{self.path} is accessible to group or others "
+                f"(mode {stat.S_IMODE(info.st_mode):o}), expected 0700"
+            )
+
+    def remove_socket(self):
+        with suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+    async def handle_peer(self, reader, writer):
+        self.peer_writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(HEADER_SIZE)
+                body = await reader.readexactly(int.from_bytes(header, "big"))
+                self.dispatch(loads(body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.peer_writers.discard(writer)
+            writer.close()
+
+    def dispatch(self, frame):
+        kind, target, message = frame
+        if kind == "send":
+            with suppress(ChannelFull):
+                self.deliver(target, message)
+        elif kind == "group":
+            self.deliver_group(target, message)
+        elif kind == "groups":
+            for group in target:
+                self.deliver_group(group, message)
+
+    # Client side
+
+    def owner(self, channel):
+        """Worker id embedded in a process-specific channel name"""
+        if "!" not in channel:
+            return None
+        return channel[: channel.index("!")].rsplit(".", 1)[-1]
+
+    def peer_path(self, worker_id):
+        return os.path.join(self.path, f"{worker_id}.sock")
+
+    def peers(self):
+        """Ids of the other live workers, re-read at most once per interval"""
+        now = time.monotonic()
+        if now - self.peers_checked > self.discovery_interval:
+            self.peers_checked = now
+            try:
+                names = os.listdir(self.path)
+            except FileNotFoundError:
+                names = []
+            self.peer_ids = [
+                name[: -len(".sock")]
+                for name in names
+                if name.endswith(".sock") and name != f"{self.worker_id}.sock"
+            ]
+        return self.peer_ids
+
+    async def forward(self, worker_ids, frame):
+        if not worker_ids:
+            return
+        body = dumps(frame).encode()
+        packet = len(body).to_bytes(HEADER_SIZE, "big") + body
+
+        # Connections are kept open only on the loop serving this worker's
+        # consumers; sends from other loops (async_to_sync in sync code) use
+        # short-lived connections that close with that loop
+        persistent = asyncio.get_running_loop() is self.loop
+        writers = []
+        for worker_id in list(worker_ids):
+            if persistent:
+                writer = await self.connect(worker_id)
+            else:
+                writer = await self.open_connection(worker_id)
+            if writer is not None:
+                writer.write(packet)
+                writers.append((worker_id, writer))
+        for worker_id, writer in writers:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                self.forget(worker_id)
+            if not persistent:
+                writer.close()
+                with suppress(ConnectionError):
+                    await writer.wait_closed()
+
+    async def connect(self, worker_id):
+        task = self.connections.get(worker_id)
+        if task is not None and task.done():
+            writer = task.result()
+            if writer is None or writer.is_closing():
+                task = None
+        if task is None:
+            task = asyncio.ensure_future(self.open_connection(worker_id))
+            self.connections[worker_id] = task
+        return await task
+
+    async def open_connection(self, worker_id):
+        try:
+            _, writer = await asyncio.open_unix_connection(self.peer_path(worker_id))
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Nobody is listening: the worker is gone
+            with suppress(FileNotFoundError):
+                os.unlink(self.peer_path(worker_id))
+            self.forget(worker_id)
+            return None
+        return writer
+
+    def forget(self, worker_id):
+        if worker_id in self.peer_ids:
+            self.peer_ids.remove(worker_id)
+        self.connections.pop(worker_id, None)
@@ -0,0 +1,294 @@
+"""
+Channel layer for the chat app.
+
+ChatChannelLayer is a drop-in replacement for channels' InMemoryChannelLayer
+on single-node deployments:
+
+- groups are indexed both ways (group -> channels, channel -> groups), so
+  membership changes and group sends never scan unrelated groups;
+- every channel has a bounded buffer, and what happens when it is full is
+  decided by the overflow policy;
+- expired messages and memberships are dropped lazily when the channel or
+  group is next touched instead of by scanning every channel on receive;
+- group_send copies the event once and hands the same copy to every
+  member, so handlers must treat events as read-only.
+
+Overflow policies:
+
+    drop_oldest  evict the oldest queued message (default)
+    coalesce     evict the oldest queued status update; a status update that
+                 finds nothing to evict is dropped, anything else raises
+                 ChannelFull
+    disconnect   empty the buffer, remove the channel from all its groups and
+                 queue a layer.overflow event so the consumer closes
+
+Counters for every outcome are kept in ChatChannelLayer.stats.
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "apps.chat.layers.ChatChannelLayer",
+            "CONFIG": {"capacity": 100, "overflow": "drop_oldest"},
+        }
+    }
+"""
+
+import asyncio
+import random
+import string
+import time
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+OVERFLOW_EVENT = {"type": "layer.overflow"}
+
+
+class ChannelBuffer:
+    __slots__ = ("capacity", "messages", "waiters")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # (expires, message) in arrival order, so the head expires first
+        self.messages = deque()
+        self.waiters = deque()
+
+
+class ChatChannelLayer(BaseChannelLayer):
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        overflow=DROP_OLDEST,
+        coalesce_types=("status_update",),
+        **kwargs,
+    ):
+        super().__init__(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **kwargs,
+        )
+        if overflow not in (DROP_OLDEST, COALESCE, DISCONNECT):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.group_expiry = group_expiry
+        self.overflow = overflow
+        self.coalesce_types = set(coalesce_types)
+        self.channels = {}
+        self.groups = {}
+        self.channel_groups = {}
+        self.stats = dict.fromkeys(
+            ["sent", "received", "expired", "dropped", "coalesced", "disconnected"],
+            0,
+        )
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        """Send a message onto a (general or specific) channel."""
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+        self.deliver(channel, dict(message))
+
+    async def receive(self, channel):
+        """Receive the first message that arrives on the channel."""
+        assert self.valid_channel_name(channel)
+        buffer = self.get_buffer(channel)
+        while True:
+            self.expire(channel, buffer)
+            if buffer.messages:
+                self.stats["received"] += 1
+                message = buffer.messages.popleft()[1]
+                if not buffer.messages and not buffer.waiters:
+                    self.channels.pop(channel, None)
+                return message
+
+            waiter = asyncio.get_running_loop().create_future()
+            buffer.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in buffer.waiters:
+                    buffer.waiters.remove(waiter)
+                elif buffer.messages:
+                    # We were woken for a message we will not consume
+                    self.wake(buffer)
+                raise
+            # The buffer may have been replaced while waiting
+            buffer = self.get_buffer(channel)
+
+    async def new_channel(self, prefix="specific."):
+        """Return a new process-local channel name."""
+        suffix = "".join(random.choice(string.ascii_letters) for _ in range(12))
+        return f"{prefix}.chat!{suffix}"
+
+    # Flush extension
+
+    async def flush(self):
+        # Receivers blocked in receive() keep waiting on their emptied
+        # buffers, so later sends still wake them
+        for buffer in self.channels.values():
+            buffer.messages.clear()
+        self.channels = {
+            channel: buffer
+            for channel, buffer in self.channels.items()
+            if buffer.waiters
+        }
+        self.groups = {}
+        self.channel_groups = {}
+
+    async def close(self):
+        pass
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self.groups.setdefault(group, {})[channel] = time.time()
+        self.channel_groups.setdefault(channel, set()).add(group)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        self.leave_group(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        self.deliver_group(group, dict(message))
+
+    async def group_send_many(self, groups, message):
+        """Send one message to several groups, copying it only once."""
+        assert isinstance(message, dict), "Message is not a dict"
+        message = dict(message)
+        for group in groups:
+            assert self.valid_group_name(group), "Invalid group name"
+            self.deliver_group(group, message)
+
+    def queue_depth(self):
+        """Messages currently buffered for the channels of this process"""
+        return sum(len(buffer.messages) for buffer in self.channels.values())
+
+    # Internals
+
+    def get_buffer(self, channel):
+        buffer = self.channels.get(channel)
+        if buffer is None:
+            buffer = ChannelBuffer(self.get_capacity(channel))
+            self.channels[channel] = buffer
+        return buffer
+
+    def leave_group(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+        groups = self.channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.channel_groups[channel]
+
+    def leave_all_groups(self, channel):
+        for group in list(self.channel_groups.get(channel, ())):
+            self.leave_group(group, channel)
+
+    def expire(self, channel, buffer):
+        """Drop expired messages at the head of a buffer"""
+        messages = buffer.messages
+        now = time.time()
+        if not messages or messages[0][0] >= now:
+            return
+        while messages and messages[0][0] < now:
+            messages.popleft()
+            self.stats["expired"] += 1
+        # Nobody is reading this channel; stop sending it group messages
+        self.leave_all_groups(channel)
+
+    def deliver_group(self, group, message):
+        members = self.groups.get(group)
+        if not members:
+            return
+        joined_after = time.time() - self.group_expiry
+        for channel, joined in list(members.items()):
+            if joined < joined_after:
+                self.leave_group(group, channel)
+                continue
+            try:
+                self.deliver(channel, message)
+            except ChannelFull:
+                pass
+
+    def deliver(self, channel, message):
+        buffer = self.get_buffer(channel)
+        self.expire(channel, buffer)
+        if len(buffer.messages) < buffer.capacity or self.make_room(
+            channel, buffer, message
+        ):
+            buffer.messages.append((time.time() + self.expiry, message))
+            self.stats["sent"] += 1
+        self.wake(buffer)
+
+    def wake(self, buffer):
+        while buffer.waiters:
+            waiter = buffer.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def make_room(self, channel, buffer, message):
+        """
+        Apply the overflow policy to a full buffer. Returns whether the new
+        message should still be queued.
+        """
+        if self.overflow == DROP_OLDEST:
+            buffer.messages.popleft()
+            self.stats["dropped"] += 1
+            return True
+
+        if self.overflow == COALESCE:
+            for index, (_, queued) in enumerate(buffer.messages):
+                if queued.get("type") in self.coalesce_types:
+                    del buffer.messages[index]
+                    self.stats["coalesced"] += 1
+                    return True
+            if message.get("type") in self.coalesce_types:
+                self.stats["coalesced"] += 1
+                return False
+            self.stats["dropped"] += 1
+            raise ChannelFull(channel)
+
+        # DISCONNECT: the consumer is too slow to keep up
+        buffer.messages.clear()
+        self.leave_all_groups(channel)
+        self.stats["disconnected"] += 1
+        buffer.messages.append((time.time() + self.expiry, dict(OVERFLOW_EVENT)))
+        return False
+
+
+async def group_send_many(channel_layer, groups, message):
+    """
+    Send one message to many groups.
+
+    Layers that implement group_send_many deliver the batch natively; for
+    any other layer the group_send calls are issued concurrently rather than
+    awaited one after another.
+    """
+    if hasattr(channel_layer, "group_send_many"):
+        await channel_layer.group_send_many(groups, message)
+        return
+    await asyncio.gather(
+        *(channel_layer.group_send(group, message) for group in groups)
+    )
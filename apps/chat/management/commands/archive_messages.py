@@ -0,0 +1,108 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.chat.archive import DEFAULT_ARCHIVE, get_archive
+from apps.chat.history import after_key
+from apps.chat.models import Message, Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than the archive age out of the messages table "
+        "into compressed per-room segment files"
+    )
+
+    def add_arguments(self, parser):
+        config = {**DEFAULT_ARCHIVE, **getattr(settings, "CHAT_ARCHIVE", {})}
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=config["AFTER_DAYS"],
+            help="Archive messages older than DAYS days",
+        )
+        parser.add_argument(
+            "--room", type=int, action="append", dest="rooms", help="Only this room"
+        )
+        parser.add_argument(
+            "--segment-size",
+            type=int,
+            default=100000,
+            help="Messages per segment file at most",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        self.archive = get_archive()
+        room_ids = options["rooms"] or (
+            Message.objects.filter(dtm_created__lt=cutoff)
+            .order_by("room_id")
+            .values_list("room_id", flat=True)
+            .distinct()
+        )
+        archived = segments = 0
+        for room_id in room_ids:
+            room_archived, room_segments = self.archive_room(room_id, cutoff, options)
+            archived += room_archived
+            segments += room_segments
+        self.stdout.write(
+            f"Archived {archived} messages older than {cutoff} "
+            f"into {segments} segments"
+        )
+
+    def archive_room(self, room_id, cutoff, options):
+        """Archive the room's old messages; returns (messages, segments)"""
+        archived = segments = 0
+        boundary = self.archive.room(room_id).boundary
+        if boundary is not None:
+            # Written to a segment by a run interrupted before deleting them
+            self.delete(room_id, boundary, options["batch_size"])
+
+        last_message_id = (
+            Room.objects.filter(pk=room_id)
+            .values_list("last_message_id", flat=True)
+            .first()
+        )
+        while True:
+            messages = Message.objects.filter(
+                room_id=room_id, dtm_created__lt=cutoff
+            ).exclude(
+                # Stays for the room lists, however old
+                id=last_message_id
+            )
+            if boundary is not None:
+                messages = after_key(messages, boundary)
+            rows = list(
+                messages.order_by("dtm_created", "id").values_list(
+                    "id", "sender_id", "dtm_created", "dtm_updated", "content"
+                )[: options["segment_size"]]
+            )
+            if not rows:
+                return archived, segments
+            # Readers switch to the segment as soon as it is in place
+            boundary = self.archive.append(room_id, rows)
+            archived += self.delete(room_id, boundary, options["batch_size"])
+            segments += 1
+
+    def delete(self, room_id, boundary, batch_size):
+        """Delete the room's messages up to the boundary from the table"""
+        dtm_created, message_id = boundary
+        archived = Message.objects.filter(
+            room_id=room_id, dtm_created__lte=dtm_created
+        ).filter(Q(dtm_created__lt=dtm_created) | Q(id__lte=message_id))
+        deleted = 0
+        while True:
+            ids = list(archived.values_list("id", flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            # Batches keep the transactions and locks short; the room's
+            # message count is refreshed as each one commits
+            deleted += (
+                Message.objects.filter(id__in=ids)
+                .delete()[1]
+                .get(Message._meta.label, 0)
+            )
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from apps.chat.frames import group_event
+from apps.chat.layers import ChatChannelLayer
+
+LAYERS = {
+    "InMemoryChannelLayer": InMemoryChannelLayer,
+    "ChatChannelLayer": ChatChannelLayer,
+}
+
+
+class Command(BaseCommand):
+    help = "Compare group_send throughput of the stock in-memory layer and ChatChannelLayer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000])
+        parser.add_argument("--messages", type=int, default=50)
+        parser.add_argument(
+            "--groups",
+            type=int,
+            default=100,
+            help="Unrelated groups that exist alongside the benchmark room",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'members':>8} {'layer':>22} {'deliveries/s':>14} {'wall ms':>10}"
+        )
+        for size in options["sizes"]:
+            for name, layer_class in LAYERS.items():
+                elapsed = asyncio.run(
+                    self.run(layer_class, size, options["messages"], options["groups"])
+                )
+                deliveries = size * options["messages"]
+                self.stdout.write(
+                    f"{size:>8} {name:>22} {deliveries / elapsed:>14,.0f} "
+                    f"{elapsed * 1e3:>10.1f}"
+                )
+
+    async def run(self, layer_class, size, messages, groups):
+        """Wall time for every member of a room to receive every broadcast"""
+        layer = layer_class(capacity=messages + 1)
+        for index in range(groups):
+            await layer.group_add(f"other_{index}", await layer.new_channel())
+
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add("benchmark", channel)
+
+        async def consume(channel):
+            for _ in range(messages):
+                await layer.receive(channel)
+
+        receivers = [asyncio.create_task(consume(channel)) for channel in channels]
+        await asyncio.sleep(0)
+
+        start = time.perf_counter()
+        for index in range(messages):
+            await layer.group_send(
+                "benchmark", group_event("chat_message", message_id=index)
+            )
+        await asyncio.gather(*receivers)
+        return time.perf_counter() - start
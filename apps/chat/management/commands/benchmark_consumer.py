@@ -0,0 +1,146 @@
+import asyncio
+import json
+import statistics
+import time
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.chat.consumers import MultiplexConsumer
+from apps.chat.management.testing import test_database
+from apps.chat.models import ChatType, Message, Room, RoomWatermark
+from apps.chat.persistence import get_persistence
+
+User = get_user_model()
+
+USER_PREFIX = "benchmark_consumer_"
+
+
+def write_message(room_id, sender_id, content, online_ids):
+    with transaction.atomic():
+        message = Message.objects.create(
+            room_id=room_id, sender_id=sender_id, content=content
+        )
+        if online_ids:
+            RoomWatermark.advance(room_id, online_ids, delivered=message.id)
+    return message
+
+
+class HopPerCallConsumer(MultiplexConsumer):
+    """
+    The message path before the async rewrite: the presence lookup and the
+    write each took their own thread-pool hop
+    """
+
+    async def save_message(self, room, message):
+        online_ids = await database_sync_to_async(self.presence.online)(
+            room.id, room.participant_ids - {self.user.id}
+        )
+        return await database_sync_to_async(write_message)(
+            room.id, self.user.id, message, online_ids
+        )
+
+
+def as_user(application, user):
+    async def app(scope, receive, send):
+        return await application({**scope, "user": user}, receive, send)
+
+    return app
+
+
+async def client(application, user, room_id, messages, latencies):
+    """Send messages one after the other, timing each until its echo"""
+    communicator = WebsocketCommunicator(as_user(application, user), "/ws/")
+    await communicator.connect()
+    await communicator.send_to(
+        text_data=json.dumps({"type": "subscribe", "room_id": room_id})
+    )
+    for seq in range(messages):
+        client_id = f"{user.id}-{seq}"
+        start = time.perf_counter()
+        await communicator.send_to(
+            text_data=json.dumps(
+                {
+                    "type": "message",
+                    "room_id": room_id,
+                    "message": f"Benchmark message {seq}",
+                    "client_id": client_id,
+                }
+            )
+        )
+        # Frames of the other clients in the room arrive in between
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout=30))
+            if frame.get("client_id") == client_id:
+                break
+        latencies.append(time.perf_counter() - start)
+    await communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure per-message latency through the chat consumer under "
+        "concurrent load, with one thread-pool hop per call and consolidated"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=20)
+        parser.add_argument("--messages", type=int, default=50)
+        parser.add_argument("--room-size", type=int, default=5)
+
+    def handle(self, *args, **options):
+        # The fixtures go into a throwaway database, never the configured one
+        with test_database():
+            self.benchmark(options)
+
+    def benchmark(self, options):
+        users = [
+            User.objects.create(username=f"{USER_PREFIX}{index}")
+            for index in range(options["clients"])
+        ]
+        assignments = []
+        for first in range(0, len(users), options["room_size"]):
+            members = users[first : first + options["room_size"]]
+            room = Room.objects.create(
+                name=f"{USER_PREFIX}{first}",
+                chat_type=ChatType.GROUP,
+                creator=members[0],
+            )
+            room.participants.add(*members)
+            assignments.extend((user, room.id) for user in members)
+
+        self.stdout.write(
+            f"{options['clients']} clients x {options['messages']} messages, "
+            f"{options['room_size']} clients per room, "
+            f"{type(get_persistence()).__name__} for the consolidated path"
+        )
+        self.stdout.write(f"{'path':<14}{'p50 ms':>10}{'p99 ms':>10}{'msg/s':>10}")
+        for label, consumer in (
+            ("hop per call", HopPerCallConsumer),
+            ("consolidated", MultiplexConsumer),
+        ):
+            self.report(label, consumer, assignments, options["messages"])
+
+    def report(self, label, consumer, assignments, messages):
+        application = consumer.as_asgi()
+        latencies = []
+
+        async def run():
+            await asyncio.gather(
+                *(
+                    client(application, user, room_id, messages, latencies)
+                    for user, room_id in assignments
+                )
+            )
+
+        start = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{label:<14}{quantiles[49] * 1e3:>10.2f}{quantiles[98] * 1e3:>10.2f}"
+            f"{len(latencies) / elapsed:>10,.0f}"
+        )
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from apps.chat.frames import group_event
+
+
+def legacy_event(index):
+    return {
+        "type": "chat_message",
+        "message": f"Benchmark message number {index} " + "x" * 80,
+        "message_id": index,
+        "sender_id": 1,
+        "sender_name": "benchmark",
+        "timestamp": "2025-01-01T00:00:00+00:00",
+    }
+
+
+def encoded_event(index):
+    payload = legacy_event(index)
+    return group_event(payload.pop("type"), **payload)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure CPU time per room broadcast for per-recipient and pre-encoded frames"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000])
+        parser.add_argument("--messages", type=int, default=20)
+
+    def handle(self, *args, **options):
+        messages = options["messages"]
+        self.stdout.write(
+            "CPU ms per broadcast; 'encode' is serialization only, "
+            "'fan-out' includes delivery through InMemoryChannelLayer"
+        )
+        self.stdout.write(
+            f"{'members':>8} {'encode/recipient':>17} {'encode once':>12} "
+            f"{'fan-out/recipient':>18} {'fan-out once':>13}"
+        )
+        for size in options["sizes"]:
+            self.stdout.write(
+                f"{size:>8} "
+                f"{self.encode(size, messages, False) * 1e3:>17.3f} "
+                f"{self.encode(size, messages, True) * 1e3:>12.3f} "
+                f"{asyncio.run(self.fanout(size, messages, False)) * 1e3:>18.3f} "
+                f"{asyncio.run(self.fanout(size, messages, True)) * 1e3:>13.3f}"
+            )
+
+    def encode(self, size, messages, pre_encoded):
+        """CPU seconds spent producing the frames of one broadcast"""
+        start = time.process_time()
+        for index in range(messages):
+            if pre_encoded:
+                event = encoded_event(index)
+                for _ in range(size):
+                    assert event["text"]
+            else:
+                event = legacy_event(index)
+                for _ in range(size):
+                    assert json.dumps(event)
+        return (time.process_time() - start) / messages
+
+    async def fanout(self, size, messages, pre_encoded):
+        """CPU seconds per broadcast, from group_send to the frame a consumer writes"""
+        layer = InMemoryChannelLayer(capacity=messages + 1)
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add("benchmark", channel)
+
+        start = time.process_time()
+        for index in range(messages):
+            if pre_encoded:
+                await layer.group_send("benchmark", encoded_event(index))
+            else:
+                await layer.group_send("benchmark", legacy_event(index))
+            for channel in channels:
+                event = await layer.receive(channel)
+                frame = event["text"] if pre_encoded else json.dumps(event)
+                assert frame
+        return (time.process_time() - start) / messages
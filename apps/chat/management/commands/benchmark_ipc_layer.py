@@ -0,0 +1,123 @@
+import asyncio
+import multiprocessing
+import shutil
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat.ipc import IPCChannelLayer
+
+
+def run_worker(index, path, options, barrier, results):
+    results.put(asyncio.run(worker(index, path, options, barrier)))
+
+
+async def worker(index, path, options, barrier):
+    """
+    One process: join `members` channels to a shared group, broadcast
+    `messages` sequence-numbered events and check what every member got.
+    """
+    workers, messages, members = (
+        options["workers"],
+        options["messages"],
+        options["members"],
+    )
+    expected = workers * messages
+    layer = IPCChannelLayer(path=path, capacity=expected + 1)
+    channels = [await layer.new_channel() for _ in range(members)]
+    for channel in channels:
+        await layer.group_add("benchmark", channel)
+
+    report = {"received": 0, "expected": expected * members, "out_of_order": 0}
+    latencies = []
+
+    async def consume(channel, record):
+        last = {}
+        for _ in range(expected):
+            event = await layer.receive(channel)
+            if record:
+                latencies.append(time.time() - event["sent"])
+            if event["seq"] <= last.get(event["sender"], -1):
+                report["out_of_order"] += 1
+            last[event["sender"]] = event["seq"]
+            report["received"] += 1
+
+    # Every worker has its socket up before anyone sends
+    barrier.wait()
+    receivers = [
+        asyncio.create_task(consume(channel, position == 0))
+        for position, channel in enumerate(channels)
+    ]
+    start = time.perf_counter()
+    for seq in range(messages):
+        await layer.group_send(
+            "benchmark",
+            {"type": "benchmark", "sender": index, "seq": seq, "sent": time.time()},
+        )
+        await asyncio.sleep(0)
+    try:
+        await asyncio.wait_for(asyncio.gather(*receivers), options["timeout"])
+    except asyncio.TimeoutError:
+        pass
+    report["elapsed"] = time.perf_counter() - start
+    report["latencies"] = latencies
+
+    barrier.wait()
+    await layer.close()
+    return report
+
+
+class Command(BaseCommand):
+    help = (
+        "Start several processes sharing an IPCChannelLayer and check "
+        "cross-process group_send delivery, ordering and latency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--messages", type=int, default=500)
+        parser.add_argument(
+            "--members", type=int, default=10, help="Group members per worker"
+        )
+        parser.add_argument("--timeout", type=float, default=30.0)
+
+    def handle(self, *args, **options):
+        path = tempfile.mkdtemp(prefix="rtm_chat_layer_")
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(options["workers"])
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=run_worker, args=(index, path, options, barrier, results)
+            )
+            for index in range(options["workers"])
+        ]
+        try:
+            for process in processes:
+                process.start()
+            reports = [results.get(timeout=options["timeout"] * 2) for _ in processes]
+            for process in processes:
+                process.join()
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+        received = sum(report["received"] for report in reports)
+        expected = sum(report["expected"] for report in reports)
+        out_of_order = sum(report["out_of_order"] for report in reports)
+        latencies = sorted(
+            latency for report in reports for latency in report["latencies"]
+        )
+        elapsed = max(report["elapsed"] for report in reports)
+        quantiles = statistics.quantiles(latencies, n=100)
+
+        self.stdout.write(f"workers          {options['workers']}")
+        self.stdout.write(f"deliveries       {received} / {expected}")
+        self.stdout.write(f"out of order     {out_of_order}")
+        self.stdout.write(f"throughput       {received / elapsed:,.0f} deliveries/s")
+        self.stdout.write(f"latency p50      {quantiles[49] * 1e3:.2f} ms")
+        self.stdout.write(f"latency p99      {quantiles[98] * 1e3:.2f} ms")
+
+        if received != expected or out_of_order:
+            raise CommandError("Cross-process delivery lost or reordered messages")
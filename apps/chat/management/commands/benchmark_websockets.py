@@ -0,0 +1,286 @@
+import asyncio
+import json
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY,
+    HASH_SESSION_KEY,
+    SESSION_KEY,
+    get_user_model,
+)
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from apps.chat.management.testing import test_database
+from apps.chat.models import ChatType, Room
+
+User = get_user_model()
+
+USER_PREFIX = "benchmark_ws_"
+
+
+class QueryCounter:
+    """execute_wrapper counting the queries of one database connection"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def install_counter(counter):
+    # Runs on the thread that channels uses for database work
+    connection.execute_wrappers.append(counter)
+
+
+def remove_counter(counter):
+    connection.execute_wrappers.remove(counter)
+
+
+def quantile(values, percent):
+    if len(values) < 2:
+        return values[0] if values else None
+    return statistics.quantiles(values, n=100)[percent - 1]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Member:
+    """One simulated browser tab: a websocket subscribed to one room"""
+
+    def __init__(self, application, user, session_key, room_id, origin):
+        self.user = user
+        self.room_id = room_id
+        self.communicator = WebsocketCommunicator(
+            application,
+            "/ws/",
+            headers=[
+                (b"origin", origin.encode()),
+                (
+                    b"cookie",
+                    f"{settings.SESSION_COOKIE_NAME}={session_key}".encode(),
+                ),
+            ],
+        )
+
+    async def connect(self):
+        start = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise CommandError(f"Websocket connection for {self.user} was refused")
+        elapsed = time.perf_counter() - start
+        await self.communicator.send_to(
+            text_data=json.dumps({"type": "subscribe", "room_id": self.room_id})
+        )
+        return elapsed
+
+    async def send(self, client_id):
+        await self.communicator.send_to(
+            text_data=json.dumps(
+                {
+                    "type": "message",
+                    "room_id": self.room_id,
+                    "message": f"Benchmark message {client_id}",
+                    "client_id": client_id,
+                }
+            )
+        )
+
+    async def receive(self, sent, latencies):
+        """Record delivery latency of the other members' messages"""
+        # Runs until cancelled: a receive timeout would stop the application
+        while True:
+            data = json.loads(await self.communicator.receive_from(timeout=None))
+            if data.get("type") != "chat_message" or data["sender_id"] == self.user.id:
+                continue
+            sent_at = sent.get(data.get("client_id"))
+            if sent_at is not None:
+                latencies.append(time.perf_counter() - sent_at)
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the websocket stack in-process through project.asgi: "
+        "R rooms x M members x K messages/s per room, written to a JSON report"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--members", type=int, default=5)
+        parser.add_argument(
+            "--rate", type=float, default=5.0, help="Messages per second per room"
+        )
+        parser.add_argument("--duration", type=float, default=10.0)
+        parser.add_argument("--origin", default="http://localhost")
+        parser.add_argument("--output", default="benchmark-websockets.json")
+        parser.add_argument(
+            "--baseline", help="Earlier report to compare the results against"
+        )
+
+    def handle(self, *args, **options):
+        # Importing it sets up the full middleware and routing stack
+        from project.asgi import application
+
+        # The fixtures go into a throwaway database, never the configured one
+        with test_database():
+            users, sessions, rooms = self.create_fixtures(options)
+            results = asyncio.run(
+                self.run(application, users, sessions, rooms, options)
+            )
+
+        report = {
+            "revision": git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "parameters": {
+                key: options[key] for key in ("rooms", "members", "rate", "duration")
+            },
+            "configuration": {
+                "channel_layer": settings.CHANNEL_LAYERS["default"]["BACKEND"],
+                "persistence": getattr(settings, "CHAT_PERSISTENCE", {}).get("BACKEND"),
+                "presence": getattr(settings, "CHAT_PRESENCE", {}).get("BACKEND"),
+                "database": connection.vendor,
+            },
+            "results": results,
+        }
+        with open(options["output"], "w") as output:
+            json.dump(report, output, indent=2)
+
+        for name, value in results.items():
+            self.stdout.write(f"{name:<28}{self.format(value)}")
+        self.stdout.write(f"Report written to {options['output']}")
+
+        if options["baseline"]:
+            self.compare(options["baseline"], results)
+
+    def create_fixtures(self, options):
+        users, sessions, rooms = [], [], []
+        for room_index in range(options["rooms"]):
+            members = [
+                User.objects.create(
+                    username=f"{USER_PREFIX}{room_index}_{member_index}"
+                )
+                for member_index in range(options["members"])
+            ]
+            room = Room.objects.create(
+                name=f"{USER_PREFIX}{room_index}",
+                chat_type=ChatType.GROUP,
+                creator=members[0],
+            )
+            room.participants.add(*members)
+            for user in members:
+                session = SessionStore()
+                session[SESSION_KEY] = str(user.pk)
+                session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+                session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+                session.create()
+                users.append(user)
+                sessions.append(session.session_key)
+                rooms.append(room.id)
+        return users, sessions, rooms
+
+    async def run(self, application, users, sessions, rooms, options):
+        members = [
+            Member(application, user, session_key, room_id, options["origin"])
+            for user, session_key, room_id in zip(users, sessions, rooms)
+        ]
+
+        # Memory is traced during connection setup only; tracing slows
+        # everything down, so the message phase runs without it
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        connect_latencies = []
+        for member in members:
+            connect_latencies.append(await member.connect())
+        memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        sent, latencies = {}, []
+        receivers = [
+            asyncio.create_task(member.receive(sent, latencies)) for member in members
+        ]
+        # Let the subscriptions and their status broadcasts settle
+        await asyncio.sleep(1)
+
+        counter = QueryCounter()
+        await sync_to_async(install_counter)(counter)
+        by_room = {}
+        for member in members:
+            by_room.setdefault(member.room_id, []).append(member)
+
+        async def send_to_room(room_members):
+            interval = 1 / options["rate"]
+            count = int(options["duration"] * options["rate"])
+            for seq in range(count):
+                sender = room_members[seq % len(room_members)]
+                client_id = f"{sender.user.id}-{seq}"
+                sent[client_id] = time.perf_counter()
+                await sender.send(client_id)
+                await asyncio.sleep(interval)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send_to_room(group) for group in by_room.values()))
+        expected = len(sent) * (options["members"] - 1)
+        # Wait for the deliveries still in flight
+        deadline = time.monotonic() + 30
+        while len(latencies) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        await sync_to_async(remove_counter)(counter)
+
+        for receiver in receivers:
+            receiver.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        for member in members:
+            await member.communicator.disconnect()
+
+        return {
+            "connections": len(members),
+            "connect_p50_ms": quantile(connect_latencies, 50) * 1e3,
+            "connect_p99_ms": quantile(connect_latencies, 99) * 1e3,
+            "messages_sent": len(sent),
+            "deliveries": len(latencies),
+            "deliveries_expected": expected,
+            "delivery_p50_ms": (quantile(sorted(latencies), 50) or 0) * 1e3,
+            "delivery_p99_ms": (quantile(sorted(latencies), 99) or 0) * 1e3,
+            "messages_per_second": len(sent) / elapsed,
+            "queries_per_message": counter.count / max(len(sent), 1),
+            "memory_per_connection_kb": memory / len(members) / 1024,
+        }
+
+    def compare(self, path, results):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        self.stdout.write(f"\nCompared with {path}:")
+        for name, value in results.items():
+            previous = baseline.get(name)
+            if isinstance(value, (int, float)) and previous:
+                change = (value - previous) / previous * 100
+                self.stdout.write(
+                    f"{name:<28}{self.format(previous)} -> "
+                    f"{self.format(value)} ({change:+.1f}%)"
+                )
+
+    @staticmethod
+    def format(value):
+        return f"{value:,.2f}" if isinstance(value, float) else f"{value:,}"
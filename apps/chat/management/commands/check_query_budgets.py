@@ -0,0 +1,273 @@
+import json
+from io import StringIO
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.urls import resolve, reverse
+
+from apps.chat import history
+from apps.chat.budgets import QueryRecorder, explain, statements
+from apps.chat.consumers import MultiplexConsumer
+from apps.chat.management.testing import test_database
+from apps.chat.models import Message
+from apps.chat.receipts import get_receipts
+
+User = get_user_model()
+
+
+def page_budget(path):
+    """The budget declared on the view or admin class serving a path"""
+    match = resolve(path)
+    view_class = getattr(match.func, "view_class", None)
+    if view_class is not None:
+        return getattr(view_class, "query_budget", None)
+    model_admin = getattr(match.func, "model_admin", None)
+    if model_admin is not None:
+        # admin:chat_room_changelist -> "changelist"
+        page = match.url_name.rsplit("_", 1)[-1]
+        return getattr(model_admin, "query_budgets", {}).get(page)
+    return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Check the query budgets of the chat views, admin pages and websocket "
+        "actions against a generated dataset in a test database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--rooms", type=int, default=300)
+        parser.add_argument("--messages", default="0:400", help="MIN:MAX per room")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--plans", action="store_true", help="Print every query and its plan"
+        )
+        parser.add_argument("--output", help="Write the results as JSON")
+
+    def handle(self, *args, **options):
+        with test_database():
+            results = self.run(options)
+
+        failures = 0
+        self.stdout.write(f"{'endpoint':<40}{'queries':>13}{'ms':>9}  result")
+        for result in results:
+            budget = result["budget"]
+            limit = "-" if budget is None else budget.queries
+            self.stdout.write(
+                f"{result['name']:<40}{len(statements(result['queries'])):>6} / {limit:<4}"
+                f"{result['time_ms']:>9.1f}  {'; '.join(result['violations']) or 'ok'}"
+            )
+            failures += bool(result["violations"])
+            if options["plans"]:
+                for query in result["queries"]:
+                    self.stdout.write(f"    {query['sql']}")
+                    for line in query["plan"]:
+                        self.stdout.write(f"        {line}")
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(
+                    [
+                        {
+                            "name": result["name"],
+                            "queries": len(statements(result["queries"])),
+                            "budget": result["budget"] and result["budget"].queries,
+                            "time_ms": result["time_ms"],
+                            "violations": result["violations"],
+                            "statements": [
+                                {"sql": query["sql"], "plan": query["plan"]}
+                                for query in result["queries"]
+                            ],
+                        }
+                        for result in results
+                    ],
+                    output,
+                    indent=2,
+                )
+
+        if failures:
+            raise CommandError(f"{failures} of {len(results)} query budgets exceeded")
+
+    def run(self, options):
+        call_command(
+            "generate_chat_data",
+            f"--users={options['users']}",
+            f"--rooms={options['rooms']}",
+            f"--messages={options['messages']}",
+            f"--seed={options['seed']}",
+            stdout=self.stdout if options["verbosity"] > 1 else StringIO(),
+        )
+        if connection.vendor in ("sqlite", "postgresql"):
+            # Plans on fresh tables depend on the planner's statistics
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+        # The busiest member of the busiest room
+        user = User.objects.annotate(room_count=Count("rooms")).latest("room_count")
+        room = user.rooms.latest("message_count")
+        message = room.last_message
+        older = Message.objects.filter(room=room).order_by("-id")[history.PAGE_SIZE]
+        admin = User.objects.create_superuser("budget_admin", "", None)
+
+        client = Client()
+        client.force_login(user)
+        # Online in the room, so that messages are delivered to someone
+        member_client = Client()
+        member_client.force_login(room.participants.exclude(pk=user.pk).first())
+        admin_client = Client()
+        admin_client.force_login(admin)
+        pages = [
+            (client, reverse("chat:index")),
+            (client, reverse("chat:room", args=[room.pk])),
+            (
+                client,
+                reverse("chat:history", args=[room.pk])
+                + f"?before={history.encode_cursor(older)}",
+            ),
+            (
+                client,
+                reverse("chat:events", args=[room.pk])
+                + f"?after={max(room.event_seq - 100, 0)}",
+            ),
+            (client, reverse("chat:search") + "?q=deploy+rev"),
+            (
+                client,
+                reverse("chat:search") + f"?q=the&room={room.pk}&before={message.pk}",
+            ),
+            (admin_client, reverse("admin:chat_room_changelist")),
+            (admin_client, reverse("admin:chat_room_change", args=[room.pk])),
+            (admin_client, reverse("admin:chat_message_changelist")),
+            (admin_client, reverse("admin:chat_message_change", args=[message.pk])),
+            (admin_client, reverse("admin:chat_roomwatermark_changelist")),
+            (admin_client, reverse("admin:chat_message_changelist") + "?q=deploy"),
+        ]
+
+        recorder = QueryRecorder()
+        recorded = []
+        with connection.execute_wrapper(recorder):
+            for page_client, path in pages:
+                response = page_client.get(path)
+                if response.status_code != 200:
+                    raise CommandError(f"GET {path} returned {response.status_code}")
+                path = path.split("?")[0]
+                recorded.append((f"GET {path}", page_budget(path), recorder.take()))
+
+            # Thread-sensitive database work of the consumer runs on this
+            # thread under async_to_sync, so the recorder sees it too
+            sessions = [
+                page_client.cookies[settings.SESSION_COOKIE_NAME].value
+                for page_client in (client, member_client)
+            ]
+            for action, queries in async_to_sync(self.drive_websocket)(
+                sessions, room, older.id, recorder
+            ):
+                recorded.append(
+                    (
+                        f"ws {action}",
+                        MultiplexConsumer.query_budgets.get(action),
+                        queries,
+                    )
+                )
+
+        results = []
+        for name, budget, queries in recorded:
+            queries = [explain(query) for query in queries]
+            if budget is None:
+                violations = ["no query budget declared"]
+            else:
+                violations = budget.violations(queries)
+            results.append(
+                {
+                    "name": name,
+                    "budget": budget,
+                    "queries": queries,
+                    "time_ms": sum(query["time"] for query in queries) * 1e3,
+                    "violations": violations,
+                }
+            )
+        return results
+
+    async def drive_websocket(self, sessions, room, since, recorder):
+        """
+        Connect, resubscribe with replay, send, acknowledge and leave as the
+        first session's user, with the second's subscribed to the room too
+        """
+        # Imported here: it sets up the full middleware and routing stack
+        from project.asgi import application
+
+        communicator, member = [
+            WebsocketCommunicator(
+                application,
+                "/ws/",
+                headers=[
+                    (b"origin", b"http://testserver"),
+                    (b"cookie", f"{settings.SESSION_COOKIE_NAME}={session}".encode()),
+                ],
+            )
+            for session in sessions
+        ]
+        # Debounced receipt broadcasts are part of the action scheduling them
+        settle = get_receipts().interval + 0.2
+
+        async def quiet(communicator=communicator):
+            while not await communicator.receive_nothing(timeout=settle):
+                await communicator.receive_from()
+
+        actions = []
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise CommandError("The websocket connection was refused")
+        actions.append(("connect", recorder.take()))
+
+        await communicator.send_json_to(
+            {"type": "subscribe", "room_id": room.pk, "since": since}
+        )
+        await quiet()
+        actions.append(("subscribe", recorder.take()))
+
+        # The other member's connection is not measured
+        await member.connect()
+        await member.send_json_to({"type": "subscribe", "room_id": room.pk})
+        await quiet(member)
+        await quiet()
+        recorder.take()
+
+        await communicator.send_json_to(
+            {
+                "type": "message",
+                "room_id": room.pk,
+                "message": "budget",
+                "client_id": "1",
+            }
+        )
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame.get("client_id") == "1":
+                break
+        await quiet()
+        actions.append(("message", recorder.take()))
+
+        await communicator.send_json_to(
+            {
+                "type": "ack",
+                "room_id": room.pk,
+                "delivered": frame["message_id"],
+                "read": frame["message_id"],
+            }
+        )
+        await quiet()
+        actions.append(("ack", recorder.take()))
+
+        await communicator.disconnect()
+        actions.append(("disconnect", recorder.take()))
+        await member.disconnect()
+        recorder.take()
+        return actions
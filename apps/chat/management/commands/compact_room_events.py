@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.chat.models import RoomEvent
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete room events older than the retention period; readers behind "
+        "the oldest kept event are told to resync"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=getattr(settings, "CHAT_EVENT_RETENTION_DAYS", 30),
+            help="Keep events of the last DAYS days",
+        )
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        deleted = 0
+        # Delete in batches to keep transactions and locks short
+        while True:
+            ids = list(
+                RoomEvent.objects.filter(dtm_created__lt=cutoff).values_list(
+                    "id", flat=True
+                )[: options["batch_size"]]
+            )
+            if not ids:
+                break
+            deleted += RoomEvent.objects.filter(id__in=ids).delete()[0]
+        self.stdout.write(f"Deleted {deleted} room events older than {cutoff}")
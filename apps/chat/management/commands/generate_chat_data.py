@@ -0,0 +1,374 @@
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from apps.chat.models import (
+    ChatType,
+    Message,
+    Room,
+    RoomEvent,
+    RoomEventKind,
+    RoomWatermark,
+)
+
+User = get_user_model()
+
+WORDS = (
+    "hey hi hello yes no maybe ok thanks sure later today tomorrow meeting "
+    "call lunch coffee deploy review merge build test fix bug ticket release "
+    "please check this that the a is are was will can could should would "
+    "when where why how what great nice cool sounds good done soon now"
+).split()
+
+
+def size_range(value):
+    """Parse MIN:MAX"""
+    try:
+        low, high = (int(part) for part in value.split(":"))
+    except ValueError:
+        raise CommandError(f"Expected MIN:MAX, got {value!r}")
+    if not 0 <= low <= high:
+        raise CommandError(f"Invalid range {value!r}")
+    return low, high
+
+
+def draw(rng, bounds, skew):
+    """
+    A size in bounds; skew > 1 makes small sizes common and large ones
+    rare, like the rooms and conversations of a real deployment
+    """
+    low, high = bounds
+    return min(high, low + int((high - low + 1) * rng.random() ** skew))
+
+
+@contextmanager
+def keep_timestamps(*models):
+    """Let bulk_create write backdated dtm_created/auto_now values"""
+    fields = [
+        field
+        for model in models
+        for field in model._meta.concrete_fields
+        if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def insert_rows(model, field_names, rows, batch_size):
+    """
+    INSERT rows of prepared database values with executemany, skipping
+    model instances and bulk_create's per-value preparation
+    """
+    quote = connection.ops.quote_name
+    columns = [model._meta.get_field(name).column for name in field_names]
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        quote(model._meta.db_table),
+        ", ".join(quote(column) for column in columns),
+        ", ".join(["%s"] * len(columns)),
+    )
+    with connection.cursor() as cursor:
+        for first in range(0, len(rows), batch_size):
+            cursor.executemany(sql, rows[first : first + batch_size])
+
+
+def insert(model, objects, batch_size):
+    """bulk_create that also sets the primary keys on every backend"""
+    model.objects.bulk_create(objects, batch_size=batch_size)
+    if objects and objects[0].pk is None:
+        # Without RETURNING (MySQL) the rows just inserted are the newest
+        # ones; the generator expects to be the only writer
+        pks = model.objects.order_by("-pk").values_list("pk", flat=True)[: len(objects)]
+        for obj, pk in zip(objects, reversed(list(pks))):
+            obj.pk = pk
+    return objects
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a deterministic synthetic dataset of users, rooms, messages, "
+        "watermarks and room events for scale testing"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--rooms", type=int, default=2000)
+        parser.add_argument(
+            "--private-share",
+            type=float,
+            default=0.7,
+            help="Fraction of the rooms that are private chats",
+        )
+        parser.add_argument(
+            "--group-size",
+            type=size_range,
+            default=(3, 50),
+            help="MIN:MAX members of a group room",
+        )
+        parser.add_argument(
+            "--messages",
+            type=size_range,
+            default=(0, 500),
+            help="MIN:MAX messages per room",
+        )
+        parser.add_argument(
+            "--skew",
+            type=float,
+            default=3.0,
+            help="How strongly sizes lean towards MIN; 1 is uniform",
+        )
+        parser.add_argument(
+            "--days", type=int, default=90, help="Days of history to spread over"
+        )
+        parser.add_argument(
+            "--end",
+            type=datetime.fromisoformat,
+            help="Time of the newest message (default: now); fix it for "
+            "identical timestamps between runs",
+        )
+        parser.add_argument("--prefix", default="synthetic_")
+        parser.add_argument("--chunk-size", type=int, default=10000)
+        parser.add_argument(
+            "--flush",
+            action="store_true",
+            help="Delete an earlier dataset with the same prefix first",
+        )
+
+    def handle(self, *args, **options):
+        prefix = options["prefix"]
+        existing = User.objects.filter(username__startswith=prefix)
+        if existing.exists():
+            if not options["flush"]:
+                raise CommandError(
+                    f"Users named {prefix}* exist; pass --flush to replace them"
+                )
+            # Rooms, messages, watermarks and events go with their users
+            existing.delete()
+
+        if options["group_size"][1] > options["users"]:
+            raise CommandError("--group-size cannot exceed --users")
+
+        self.rng = random.Random(options["seed"])
+        self.chunk_size = options["chunk_size"]
+        self.end = options["end"] or timezone.now()
+        if timezone.is_naive(self.end):
+            self.end = timezone.make_aware(self.end)
+        # Event payloads carry the timestamps as Message.event_payload does
+        self.end = self.end.astimezone(dt_timezone.utc)
+        self.start = self.end - timedelta(days=options["days"])
+        # Events before the retention period would be compacted away
+        self.events_since = self.end - timedelta(
+            days=getattr(settings, "CHAT_EVENT_RETENTION_DAYS", 30)
+        )
+
+        started = time.perf_counter()
+        with keep_timestamps(Room):
+            user_ids = self.create_users(prefix, options["users"])
+            rooms = self.create_rooms(prefix, user_ids, options)
+            totals = self.create_messages(rooms, options)
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{len(user_ids):,} users, {len(rooms):,} rooms, "
+            f"{totals['memberships']:,} memberships, {totals['messages']:,} "
+            f"messages, {totals['events']:,} events in {elapsed:.1f}s "
+            f"({totals['messages'] / elapsed:,.0f} messages/s)"
+        )
+
+    def create_users(self, prefix, count):
+        users = [
+            User(username=f"{prefix}{index}", password="!") for index in range(count)
+        ]
+        with transaction.atomic():
+            insert(User, users, self.chunk_size)
+        return [user.pk for user in users]
+
+    def create_rooms(self, prefix, user_ids, options):
+        """Rooms with their members and creation times, oldest first"""
+        rooms = []
+        for index in range(options["rooms"]):
+            if self.rng.random() < options["private_share"]:
+                chat_type, size, name = ChatType.PRIVATE, 2, ""
+            else:
+                chat_type = ChatType.GROUP
+                size = max(2, draw(self.rng, options["group_size"], options["skew"]))
+                name = f"{prefix}group_{index}"
+            members = self.rng.sample(user_ids, size)
+            created = self.start + (self.end - self.start) * self.rng.random() ** 0.5
+            room = Room(
+                name=name,
+                chat_type=chat_type,
+                creator_id=members[0],
+                dtm_created=created,
+                dtm_updated=created,
+            )
+            room.member_ids = members
+            rooms.append(room)
+        rooms.sort(key=lambda room: room.dtm_created)
+
+        with transaction.atomic():
+            insert(Room, rooms, self.chunk_size)
+            insert_rows(
+                Room.participants.through,
+                ["room", "user"],
+                [(room.pk, user_id) for room in rooms for user_id in room.member_ids],
+                self.chunk_size,
+            )
+        return rooms
+
+    def create_messages(self, rooms, options):
+        """
+        Write messages room by room in chunks, together with the watermarks,
+        events and denormalized Room fields that Message.save and the
+        membership signals would have maintained
+        """
+        # Ids are allocated here rather than returned by the INSERTs, which
+        # works on every backend and saves building model instances
+        self.next_id = (Message.objects.aggregate(Max("id"))["id__max"] or 0) + 1
+        totals = {"memberships": 0, "messages": 0, "events": 0}
+        pending = []
+        pending_messages = 0
+        for room in rooms:
+            count = draw(self.rng, options["messages"], options["skew"])
+            span = (self.end - room.dtm_created).total_seconds()
+            times = sorted(self.rng.random() * span for _ in range(count))
+            room.new_messages = [
+                (
+                    self.next_id + index,
+                    self.rng.choice(room.member_ids),
+                    " ".join(self.rng.choices(WORDS, k=self.rng.randint(1, 20))),
+                    room.dtm_created + timedelta(seconds=offset),
+                )
+                for index, offset in enumerate(times)
+            ]
+            self.next_id += count
+            pending.append(room)
+            pending_messages += count
+            if pending_messages >= self.chunk_size:
+                self.write_chunk(pending, totals)
+                pending, pending_messages = [], 0
+        if pending:
+            self.write_chunk(pending, totals)
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Message]):
+                cursor.execute(sql)
+        return totals
+
+    def write_chunk(self, rooms, totals):
+        adapt = connection.ops.adapt_datetimefield_value
+        adapt_json = connection.ops.adapt_json_value
+        messages, events, watermarks = [], [], []
+        for room in rooms:
+            # The members joining is the first event of every room
+            seq = 1
+            if room.dtm_created >= self.events_since:
+                payload = {"change": "joined", "user_ids": sorted(room.member_ids)}
+                events.append(
+                    (
+                        room.pk,
+                        seq,
+                        RoomEventKind.MEMBERSHIP,
+                        adapt_json(payload, None),
+                        adapt(room.dtm_created),
+                    )
+                )
+            for message_id, sender_id, content, created in room.new_messages:
+                seq += 1
+                db_created = adapt(created)
+                messages.append(
+                    (message_id, room.pk, sender_id, content, db_created, db_created)
+                )
+                if created >= self.events_since:
+                    # The payload of Message.event_payload
+                    payload = {
+                        "message_id": message_id,
+                        "sender_id": sender_id,
+                        "content": content,
+                        "timestamp": created.isoformat(),
+                    }
+                    events.append(
+                        (
+                            room.pk,
+                            seq,
+                            RoomEventKind.MESSAGE,
+                            adapt_json(payload, None),
+                            db_created,
+                        )
+                    )
+            room.event_seq = seq
+            room.message_count = len(room.new_messages)
+            if room.new_messages:
+                room.last_message_id = room.new_messages[-1][0]
+                room.last_activity = room.new_messages[-1][3]
+            seen = adapt(room.last_activity or room.dtm_created)
+            watermarks.extend(
+                (room.pk, user_id, delivered, read, seen)
+                for user_id, delivered, read in self.watermarks(room)
+            )
+
+        with transaction.atomic():
+            insert_rows(
+                Message,
+                ["id", "room", "sender", "content", "dtm_created", "dtm_updated"],
+                messages,
+                self.chunk_size,
+            )
+            insert_rows(
+                RoomEvent,
+                ["room", "seq", "kind", "payload", "dtm_created"],
+                events,
+                self.chunk_size,
+            )
+            insert_rows(
+                RoomWatermark,
+                ["room", "user", "last_delivered_id", "last_read_id", "timestamp"],
+                watermarks,
+                self.chunk_size,
+            )
+            Room.objects.bulk_update(
+                rooms,
+                ["last_message", "last_activity", "message_count", "event_seq"],
+                batch_size=1000,
+            )
+
+        totals["memberships"] += sum(len(room.member_ids) for room in rooms)
+        totals["messages"] += len(messages)
+        totals["events"] += len(events)
+        for room in rooms:
+            # Free the chunk's messages
+            del room.new_messages
+
+    def watermarks(self, room):
+        """
+        (user_id, delivered, read) of the members: most have read
+        everything; the others lag behind by a few messages, and some of
+        those have not even received the newest ones
+        """
+        ids = [message[0] for message in room.new_messages]
+        for user_id in room.member_ids:
+            if not ids:
+                yield user_id, 0, 0
+            elif self.rng.random() < 0.6:
+                yield user_id, ids[-1], ids[-1]
+            else:
+                lag = min(len(ids), int(self.rng.expovariate(1 / 20)) + 1)
+                read = ids[-lag - 1] if lag < len(ids) else 0
+                delivered = ids[-1] if self.rng.random() < 0.5 else read
+                yield user_id, delivered, read
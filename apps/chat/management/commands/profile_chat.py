@@ -0,0 +1,76 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat.profiling import get_profiler
+
+
+class Command(BaseCommand):
+    help = (
+        "Turn the sampling profiler on for some users, paths or a share of "
+        "the requests and websocket frames of every process, or turn it off"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user",
+            action="append",
+            default=[],
+            dest="users",
+            help="Profile this user's requests and frames (repeatable)",
+        )
+        parser.add_argument(
+            "--path",
+            action="append",
+            default=[],
+            dest="paths",
+            help="Profile paths starting with this prefix, e.g. /room/ or "
+            "/ws/ for websocket frames (repeatable)",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=1.0,
+            help="Fraction of the matching requests and frames to profile",
+        )
+        parser.add_argument(
+            "--minutes",
+            type=float,
+            default=10,
+            help="Turn profiling off again after this long",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=100,
+            help="Profiles written per process at most",
+        )
+        parser.add_argument("--off", action="store_true", help="Stop profiling")
+
+    def handle(self, *args, **options):
+        profiler = get_profiler()
+        if profiler is None:
+            raise CommandError("Set CHAT_PROFILING_DIR to enable profiling")
+
+        if options["off"]:
+            profiler.rules_file.clear()
+            self.stdout.write("Profiling is off")
+            return
+
+        if not 0 < options["rate"] <= 1:
+            raise CommandError("--rate must be in (0, 1]")
+        if not (options["users"] or options["paths"] or options["rate"] < 1):
+            raise CommandError(
+                "Refusing to profile everything; pass --user, --path or --rate"
+            )
+        profiler.rules_file.write(
+            until=time.time() + options["minutes"] * 60,
+            users=options["users"],
+            paths=options["paths"],
+            rate=options["rate"],
+            limit=options["limit"],
+        )
+        self.stdout.write(
+            f"Profiling for {options['minutes']:g} minutes; profiles are "
+            f"written to {profiler.directory}"
+        )
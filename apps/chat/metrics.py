@@ -0,0 +1,173 @@
+"""
+Process-local metrics for the chat websocket tier, served at /metrics in
+the Prometheus text format.
+
+Every daphne process counts its own connections and frames, so each one
+is scraped separately. Metrics are defined once at import time. The hot
+path only adds to preallocated slots: a counter is a number in a dict
+keyed by its label value, a histogram a fixed list of bucket counts. The
+series of a label value is created the first time that value is seen, so
+label values must come from a small fixed set (consumer class names,
+frame types).
+
+Channel layer figures are read from the layer when scraped rather than
+counted on the way through.
+"""
+
+from bisect import bisect_left
+
+from channels.layers import get_channel_layer
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        # label value (None without a label) -> value or histogram series
+        self.series = {}
+
+    def selector(self, value, extra=""):
+        labels = [f'{self.label}="{value}"'] if self.label else []
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for value, sample in list(self.series.items()):
+            yield from self.samples(value, sample)
+
+    def samples(self, value, sample):
+        yield f"{self.name}{self.selector(value)} {sample}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value=None, amount=1):
+        self.series[value] = self.series.get(value, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, value=None, amount=1):
+        self.series[value] = self.series.get(value, 0) + amount
+
+    def dec(self, value=None, amount=1):
+        self.series[value] = self.series.get(value, 0) - amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets, label=None):
+        super().__init__(name, documentation, label)
+        self.buckets = buckets
+
+    def observe(self, amount, value=None):
+        series = self.series.get(value)
+        if series is None:
+            # [bucket counts..., +Inf count, sum]
+            series = self.series[value] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, amount)] += 1
+        series[-1] += amount
+
+    def samples(self, value, series):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), series):
+            cumulative += count
+            bucket = 'le="%s"' % bound
+            yield f"{self.name}_bucket{self.selector(value, bucket)} {cumulative}"
+        yield f"{self.name}_sum{self.selector(value)} {series[-1]}"
+        yield f"{self.name}_count{self.selector(value)} {cumulative}"
+
+
+CONNECTIONS_OPENED = Counter(
+    "chat_connections_opened_total", "Websocket connections accepted", "consumer"
+)
+CONNECTIONS_CLOSED = Counter(
+    "chat_connections_closed_total", "Websocket connections closed", "consumer"
+)
+CONNECTIONS_ACTIVE = Gauge(
+    "chat_connections_active", "Open websocket connections", "consumer"
+)
+FRAMES_RECEIVED = Counter(
+    "chat_frames_received_total", "Client frames received", "frame"
+)
+BROADCAST_LATENCY = Histogram(
+    "chat_broadcast_latency_seconds",
+    "Time from receiving a message frame to handing its broadcast to the layer",
+    LATENCY_BUCKETS,
+)
+FRAME_DB_TIME = Histogram(
+    "chat_frame_db_seconds",
+    "Time spent waiting for the database per client frame",
+    LATENCY_BUCKETS,
+    "frame",
+)
+LAYER_SEND_LATENCY = Histogram(
+    "chat_layer_send_seconds",
+    "Channel layer group_send latency",
+    LATENCY_BUCKETS,
+    "event",
+)
+FANOUT = Histogram(
+    "chat_fanout_size",
+    "Recipients of a room broadcast or notification fan-out",
+    FANOUT_BUCKETS,
+    "event",
+)
+
+METRICS = [
+    CONNECTIONS_OPENED,
+    CONNECTIONS_CLOSED,
+    CONNECTIONS_ACTIVE,
+    FRAMES_RECEIVED,
+    BROADCAST_LATENCY,
+    FRAME_DB_TIME,
+    LAYER_SEND_LATENCY,
+    FANOUT,
+]
+
+
+def render_layer():
+    """Queue depth and delivery outcomes of the process's channel layer"""
+    channel_layer = get_channel_layer()
+    if hasattr(channel_layer, "queue_depth"):
+        yield "# HELP chat_layer_queue_depth Messages buffered for local channels"
+        yield "# TYPE chat_layer_queue_depth gauge"
+        yield f"chat_layer_queue_depth {channel_layer.queue_depth()}"
+    stats = getattr(channel_layer, "stats", None)
+    if stats:
+        yield "# HELP chat_layer_messages_total Channel layer messages by outcome"
+        yield "# TYPE chat_layer_messages_total counter"
+        for outcome, count in stats.items():
+            yield f'chat_layer_messages_total{{outcome="{outcome}"}} {count}'
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = [line for metric in METRICS for line in metric.render()]
+    lines.extend(render_layer())
+    return "\n".join(lines) + "\n"
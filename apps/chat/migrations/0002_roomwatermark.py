@@ -0,0 +1,132 @@
+# Generated by Django 5.1 on 2026-10-18 07:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, Min, Q
+
+
+def receipts_to_watermarks(apps, schema_editor):
+    """
+    Collapse per-message receipts into one watermark per room participant.
+
+    A watermark sits just below the first message that has not reached the
+    state, so no message is reported as delivered/read when it was not.
+    """
+    Room = apps.get_model("chat", "Room")
+    Message = apps.get_model("chat", "Message")
+    MessageReceipt = apps.get_model("chat", "MessageReceipt")
+    RoomWatermark = apps.get_model("chat", "RoomWatermark")
+
+    latest = dict(
+        Message.objects.values("room_id")
+        .annotate(latest=Max("id"))
+        .values_list("room_id", "latest")
+    )
+    pending = {
+        (row["message__room_id"], row["user_id"]): row
+        for row in MessageReceipt.objects.values("message__room_id", "user_id")
+        .annotate(
+            first_sent=Min("message_id", filter=Q(status="sent")),
+            first_unread=Min("message_id", filter=~Q(status="read")),
+        )
+        .order_by()
+    }
+
+    watermarks = []
+    for room_id, user_id in Room.participants.through.objects.values_list(
+        "room_id", "user_id"
+    ):
+        room_latest = latest.get(room_id, 0)
+        row = pending.get((room_id, user_id), {})
+        first_sent = row.get("first_sent")
+        first_unread = row.get("first_unread")
+        watermarks.append(
+            RoomWatermark(
+                room_id=room_id,
+                user_id=user_id,
+                last_delivered_id=first_sent - 1 if first_sent else room_latest,
+                last_read_id=first_unread - 1 if first_unread else room_latest,
+            )
+        )
+    RoomWatermark.objects.bulk_create(watermarks, batch_size=1000)
+
+
+def watermarks_to_receipts(apps, schema_editor):
+    """Expand watermarks back into one receipt per message and recipient"""
+    Message = apps.get_model("chat", "Message")
+    MessageReceipt = apps.get_model("chat", "MessageReceipt")
+    RoomWatermark = apps.get_model("chat", "RoomWatermark")
+
+    for watermark in RoomWatermark.objects.iterator():
+        message_ids = (
+            Message.objects.filter(room_id=watermark.room_id)
+            .exclude(sender_id=watermark.user_id)
+            .values_list("id", flat=True)
+        )
+        receipts = []
+        for message_id in message_ids.iterator():
+            if message_id <= watermark.last_read_id:
+                status = "read"
+            elif message_id <= watermark.last_delivered_id:
+                status = "delivered"
+            else:
+                status = "sent"
+            receipts.append(
+                MessageReceipt(
+                    message_id=message_id, user_id=watermark.user_id, status=status
+                )
+            )
+        MessageReceipt.objects.bulk_create(receipts, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RoomWatermark",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_delivered_id", models.BigIntegerField(default=0)),
+                ("last_read_id", models.BigIntegerField(default=0)),
+                ("timestamp", models.DateTimeField(auto_now=True)),
+                (
+                    "room",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="watermarks",
+                        to="chat.room",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="room_watermarks",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "get_latest_by": "timestamp",
+                "unique_together": {("room", "user")},
+            },
+        ),
+        migrations.RunPython(receipts_to_watermarks, watermarks_to_receipts),
+        migrations.DeleteModel(
+            name="MessageReceipt",
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1 on 2026-10-18 07:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_room_activity(apps, schema_editor):
+    Room = apps.get_model("chat", "Room")
+    Message = apps.get_model("chat", "Message")
+
+    latest = Message.objects.filter(room=OuterRef("pk")).order_by("-dtm_created", "-id")
+    counts = (
+        Message.objects.filter(room=OuterRef("pk"))
+        .order_by()
+        .values("room")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    Room.objects.update(
+        last_message=Subquery(latest.values("id")[:1]),
+        last_activity=Subquery(latest.values("dtm_created")[:1]),
+        message_count=Coalesce(Subquery(counts), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0004_message_history_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="last_activity",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="last_message",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="chat.message",
+            ),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_room_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1 on 2026-10-18 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0005_room_activity"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="roompresence",
+            name="channel_name",
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AlterUniqueTogether(
+            name="roompresence",
+            unique_together={("channel_name", "room")},
+        ),
+    ]
@@ -0,0 +1,72 @@
+from django.db import migrations
+
+# An external-content FTS5 table over chat_message.content; the triggers
+# keep it in step with every insert, edit and delete, including the raw
+# and bulk writes that bypass Message.save. A later migration that makes
+# SQLite rebuild chat_message (most AlterField changes) drops the triggers
+# with the old table and has to create them again.
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE chat_message_fts USING fts5(
+        content,
+        content='chat_message',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts (chat_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content ON chat_message
+    BEGIN
+        INSERT INTO chat_message_fts (chat_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_message_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # Index the existing messages
+    "INSERT INTO chat_message_fts (chat_message_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER chat_message_fts_update",
+    "DROP TRIGGER chat_message_fts_delete",
+    "DROP TRIGGER chat_message_fts_insert",
+    "DROP TABLE chat_message_fts",
+]
+
+# InnoDB maintains FULLTEXT indexes itself
+MYSQL_FORWARD = [
+    "ALTER TABLE chat_message ADD FULLTEXT INDEX chat_message_content_fts (content)"
+]
+MYSQL_BACKWARD = ["ALTER TABLE chat_message DROP INDEX chat_message_content_fts"]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0007_room_events"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"sqlite": SQLITE_FORWARD, "mysql": MYSQL_FORWARD}),
+            run({"sqlite": SQLITE_BACKWARD, "mysql": MYSQL_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0008_message_search"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["dtm_created"], name="chat_message_created"),
+        ),
+    ]
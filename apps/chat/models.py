@@ -1,5 +1,11 @@
+import heapq
+from operator import itemgetter
+
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from qux.models import QuxModel
@@ -27,6 +33,32 @@ class Room(QuxModel):
         User, on_delete=models.CASCADE, related_name="created_rooms"
     )
     participants = models.ManyToManyField(User, related_name="rooms")
+    # Denormalized from messages for the room lists; kept current by
+    # record_messages
+    last_message = models.ForeignKey(
+        "Message",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    last_activity = models.DateTimeField(null=True, blank=True, db_index=True)
+    message_count = models.PositiveIntegerField(default=0)
+    # Sequence number of the room's latest RoomEvent
+    event_seq = models.PositiveBigIntegerField(default=0)
+
+    # Maintained with F() updates as messages and events are written
+    COUNTER_FIELDS = {"last_message", "last_activity", "message_count", "event_seq"}
+
+    def save(self, *args, **kwargs):
+        # A full save of a stale instance must not rewind the counters
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
 
     def get_room_name(self):
         """Sync method to get room name"""
@@ -42,9 +74,40 @@ class Room(QuxModel):
     def get_other_participant(self):
         """Get the other participant in a private chat"""
         if self.chat_type == ChatType.PRIVATE:
-            return self.participants.exclude(id=self.creator.id).first()
+            # Iterate so that prefetched participants are reused
+            for participant in self.participants.all():
+                if participant.id != self.creator_id:
+                    return participant
         return None
 
+    @classmethod
+    def record_messages(cls, room_id, messages):
+        """
+        Count newly inserted messages of the room, oldest first, in its
+        denormalized fields and write their MESSAGE events, all with one
+        UPDATE of the room; call inside the inserting transaction
+        """
+        last = messages[-1]
+        cls.objects.filter(pk=room_id).update(
+            last_message=last,
+            last_activity=last.dtm_created,
+            message_count=F("message_count") + len(messages),
+            event_seq=F("event_seq") + len(messages),
+        )
+        RoomEvent.record(
+            room_id,
+            RoomEventKind.MESSAGE,
+            [message.event_payload() for message in messages],
+        )
+
+    def refresh_activity(self):
+        """Recompute the denormalized message fields, e.g. after deletions"""
+        last_message = self.messages.order_by("-dtm_created", "-id").first()
+        self.last_message = last_message
+        self.last_activity = last_message.dtm_created if last_message else None
+        self.message_count = self.messages.count()
+        self.save(update_fields=["last_message", "last_activity", "message_count"])
+
 
 class Message(QuxModel):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="messages")
@@ -55,70 +118,344 @@ class Message(QuxModel):
 
     class Meta:
         ordering = ["dtm_created"]
+        indexes = [
+            models.Index(
+                fields=["room", "dtm_created", "id"], name="chat_message_history"
+            ),
+            # For the admin's date hierarchy
+            models.Index(fields=["dtm_created"], name="chat_message_created"),
+        ]
+
+    def save(self, *args, **kwargs):
+        creating = self._state.adding
+        # Without a savepoint when nested; the callers roll back as a whole
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+            if creating:
+                Room.record_messages(self.room_id, [self])
+
+    def event_payload(self):
+        payload = {
+            "message_id": self.id,
+            "sender_id": self.sender_id,
+            "content": self.content,
+            "timestamp": self.dtm_created.isoformat(),
+        }
+        # Members the persistence backends delivered the message to as it
+        # was sent; their delivered watermarks move to it without a STATUS
+        # event of its own
+        delivered_to = getattr(self, "delivered_to", None)
+        if delivered_to:
+            payload["delivered_to"] = sorted(delivered_to)
+        return payload
 
     def get_status_for_user(self, user):
         """Get the message status for a specific user"""
-        try:
-            receipt = self.receipts.get(user=user)
-            return receipt.status
-        except MessageReceipt.DoesNotExist:
+        watermark = RoomWatermark.objects.filter(
+            room_id=self.room_id, user=user
+        ).first()
+        if watermark is None:
             return MessageStatus.SENT
+        return watermark.get_status(self.id)
 
     def get_status_display(self):
         """Get overall message status for display"""
-        if not self.receipts.exists():
-            return MessageStatus.SENT
+        if hasattr(self, "_status_display"):
+            return self._status_display
+        floor = RoomWatermark.floor(self.room_id, exclude_user_id=self.sender_id)
+        return RoomWatermark.floor_status(floor, self.id)
 
-        statuses = list(self.receipts.values_list("status", flat=True))
-        if all(status == MessageStatus.READ for status in statuses):
-            return MessageStatus.READ
-        if all(
-            status in [MessageStatus.DELIVERED, MessageStatus.READ]
-            for status in statuses
-        ):
-            return MessageStatus.DELIVERED
-        return MessageStatus.SENT
+    @classmethod
+    def prefetch_statuses(cls, messages):
+        """
+        Resolve get_status_display() for many messages with a single
+        watermark query instead of one aggregate per message
+        """
+        messages = list(messages)
+        watermarks = {}
+        for room_id, user_id, delivered, read in RoomWatermark.objects.filter(
+            room_id__in={message.room_id for message in messages}
+        ).values_list("room_id", "user_id", "last_delivered_id", "last_read_id"):
+            watermarks.setdefault(room_id, []).append((user_id, delivered, read))
+
+        floors = {}
+        for message in messages:
+            key = (message.room_id, message.sender_id)
+            if key not in floors:
+                others = [
+                    (delivered, read)
+                    for user_id, delivered, read in watermarks.get(message.room_id, [])
+                    if user_id != message.sender_id
+                ]
+                floors[key] = {
+                    "total": len(others),
+                    "delivered": min((d for d, _ in others), default=None),
+                    "read": min((r for _, r in others), default=None),
+                }
+            message._status_display = RoomWatermark.floor_status(
+                floors[key], message.id
+            )
+        return messages
 
     def mark_as_delivered(self, user):
         """Mark message as delivered for a user"""
-        MessageReceipt.objects.update_or_create(
-            message=self, user=user, defaults={"status": MessageStatus.DELIVERED}
-        )
+        RoomWatermark.advance(self.room_id, [user.id], delivered=self.id)
 
     def mark_as_read(self, user):
         """Mark message as read for a user"""
-        MessageReceipt.objects.update_or_create(
-            message=self, user=user, defaults={"status": MessageStatus.READ}
+        RoomWatermark.advance(self.room_id, [user.id], read=self.id)
+
+
+class RoomWatermark(models.Model):
+    """
+    Per-member delivery/read state for a room.
+
+    Message ids grow monotonically within a room, so a single row holding the
+    highest delivered and read message ids describes the status of every
+    message in the room for that user.
+    """
+
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="watermarks")
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="room_watermarks"
+    )
+    last_delivered_id = models.BigIntegerField(default=0)
+    last_read_id = models.BigIntegerField(default=0)
+    timestamp = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ["room", "user"]
+        get_latest_by = "timestamp"
+
+    def get_status(self, message_id):
+        """Status of the given message as seen by this member"""
+        if message_id <= self.last_read_id:
+            return MessageStatus.READ
+        if message_id <= self.last_delivered_id:
+            return MessageStatus.DELIVERED
+        return MessageStatus.SENT
+
+    @classmethod
+    def floor(cls, room_id, exclude_user_id=None):
+        """
+        Lowest delivered and read watermarks in a room, i.e. the newest
+        message every other member has received / read
+        """
+        watermarks = cls.objects.filter(room_id=room_id)
+        if exclude_user_id is not None:
+            watermarks = watermarks.exclude(user_id=exclude_user_id)
+        return watermarks.aggregate(
+            total=models.Count("id"),
+            delivered=models.Min("last_delivered_id"),
+            read=models.Min("last_read_id"),
         )
 
-    def create_receipts(self, exclude_user=None):
-        """Create initial SENT receipts for all participants"""
-        participants = self.room.participants.all()
-        if exclude_user:
-            participants = participants.exclude(id=exclude_user.id)
+    @staticmethod
+    def floor_status(floor, message_id):
+        """Overall status of a message given the room floor"""
+        if not floor["total"]:
+            return MessageStatus.SENT
+        if floor["read"] >= message_id:
+            return MessageStatus.READ
+        if floor["delivered"] >= message_id:
+            return MessageStatus.DELIVERED
+        return MessageStatus.SENT
+
+    @classmethod
+    def advance(
+        cls, room_id, user_ids, delivered=None, read=None, clamp=False, log=True
+    ):
+        """
+        Move the watermarks of the given users forward in a single UPDATE.
+        Watermarks never move backwards; reading a message implies delivery.
+        With clamp, ids beyond the room's latest message are capped at it,
+        which is how acknowledgements sent by clients are applied.
+
+        Unless log is false, a STATUS event {"user_ids", "delivered",
+        "read"} records that the users got at least that far. Callers
+        recording the move otherwise pass log=False, like the persistence
+        backends, which list the recipients in the MESSAGE event.
+        """
+        if read is not None:
+            delivered = max(delivered or 0, read)
+        if delivered is None:
+            return 0
+
+        # Nested without savepoints; a failure rolls back the caller's
+        # transaction as a whole
+        with transaction.atomic(savepoint=False):
+            if clamp:
+                latest = (
+                    Room.objects.filter(pk=room_id)
+                    .values_list("last_message_id", flat=True)
+                    .first()
+                ) or 0
+                delivered = min(delivered, latest)
+                read = None if read is None else min(read, latest)
+
+            changes = {
+                "last_delivered_id": Greatest("last_delivered_id", Value(delivered)),
+                "timestamp": timezone.now(),
+            }
+            behind = models.Q(last_delivered_id__lt=delivered)
+            if read is not None:
+                changes["last_read_id"] = Greatest("last_read_id", Value(read))
+                behind |= models.Q(last_read_id__lt=read)
+
+            # Only watermarks that actually move are written; nothing is
+            # logged if none did
+            updated = (
+                cls.objects.filter(room_id=room_id, user_id__in=user_ids)
+                .filter(behind)
+                .update(**changes)
+            )
+            if updated and log:
+                payload = {"user_ids": sorted(user_ids), "delivered": delivered}
+                if read is not None:
+                    payload["read"] = read
+                RoomEvent.append(room_id, RoomEventKind.STATUS, [payload])
+        return updated
+
+    @classmethod
+    def for_room(cls, room_id):
+        """[user_id, last_delivered_id, last_read_id] of every member"""
+        return [
+            list(row)
+            for row in cls.objects.filter(room_id=room_id).values_list(
+                "user_id", "last_delivered_id", "last_read_id"
+            )
+        ]
 
-        MessageReceipt.objects.bulk_create(
+    @staticmethod
+    def lowest(rows):
+        """
+        The rows of for_room() holding the two lowest delivered and the two
+        lowest read watermarks. The lowest watermarks of the members other
+        than any one of them are among these, so clients derive the status
+        of their messages from them as from all rows.
+        """
+        lowest = {}
+        for column in (1, 2):
+            for row in heapq.nsmallest(2, rows, key=itemgetter(column)):
+                lowest[row[0]] = row
+        return list(lowest.values())
+
+    @classmethod
+    def create_for_members(cls, room_id, user_ids):
+        """
+        Create watermarks for new members, starting at the latest message so
+        that history from before they joined does not count against them.
+        """
+        latest = (
+            Message.objects.filter(room_id=room_id).aggregate(latest=models.Max("id"))[
+                "latest"
+            ]
+            or 0
+        )
+        cls.objects.bulk_create(
             [
-                MessageReceipt(
-                    message=self, user=participant, status=MessageStatus.SENT
+                cls(
+                    room_id=room_id,
+                    user_id=user_id,
+                    last_delivered_id=latest,
+                    last_read_id=latest,
                 )
-                for participant in participants
+                for user_id in user_ids
+            ],
+            ignore_conflicts=True,
+        )
+
+
+class RoomEventKind(models.TextChoices):
+    MESSAGE = "message", _("Message")
+    STATUS = "status", _("Status")
+    MEMBERSHIP = "membership", _("Membership")
+
+
+class RoomEvent(models.Model):
+    """
+    Append-only log of what changed in a room, for incremental sync.
+
+    Every room numbers its events 1, 2, 3, ... without gaps. Numbers are
+    allocated by incrementing Room.event_seq in the transaction that makes
+    the change, so the events commit or roll back with it, and concurrent
+    writers to a room queue up on its row lock rather than leave holes.
+    Events older than CHAT_EVENT_RETENTION_DAYS are removed by the
+    compact_room_events command; readers behind that are told to resync.
+    """
+
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="events")
+    seq = models.PositiveBigIntegerField()
+    kind = models.CharField(max_length=20, choices=RoomEventKind.choices)
+    payload = models.JSONField(default=dict)
+    dtm_created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ["room", "seq"]
+        ordering = ["seq"]
+
+    @classmethod
+    def append(cls, room_id, kind, payloads):
+        """Allocate sequence numbers for and write events of one kind"""
+        with transaction.atomic(savepoint=False):
+            Room.objects.filter(pk=room_id).update(
+                event_seq=F("event_seq") + len(payloads)
+            )
+            return cls.record(room_id, kind, payloads)
+
+    @classmethod
+    def record(cls, room_id, kind, payloads):
+        """
+        Write events whose sequence numbers the caller already allocated
+        by adding len(payloads) to Room.event_seq in the current transaction
+        """
+        last = Room.objects.filter(pk=room_id).values_list("event_seq", flat=True).get()
+        first = last - len(payloads) + 1
+        return cls.objects.bulk_create(
+            [
+                cls(room_id=room_id, seq=first + offset, kind=kind, payload=payload)
+                for offset, payload in enumerate(payloads)
             ]
         )
 
+    @classmethod
+    def read(cls, room_id, after=0, limit=100):
+        """
+        Return (events, last_seq, reset) for the events following seq
+        `after`. reset means events the reader has not seen were compacted
+        away, so it has to resync from the models instead.
+        """
+        last_seq = (
+            Room.objects.filter(pk=room_id).values_list("event_seq", flat=True).get()
+        )
+        events = list(
+            cls.objects.filter(room_id=room_id, seq__gt=after).order_by("seq")[:limit]
+        )
+        if events:
+            reset = events[0].seq != after + 1
+        else:
+            reset = last_seq > after
+        return events, last_seq, reset
+
+    def as_dict(self):
+        return {
+            "seq": self.seq,
+            "kind": self.kind,
+            "payload": self.payload,
+            "timestamp": self.dtm_created.isoformat(),
+        }
 
-class MessageReceipt(models.Model):
-    message = models.ForeignKey(
-        Message, on_delete=models.CASCADE, related_name="receipts"
-    )
+
+class RoomPresence(models.Model):
+    """One row per room of an open websocket connection, used by DatabasePresence"""
+
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="presence")
     user = models.ForeignKey(
-        User, on_delete=models.CASCADE, related_name="message_receipts"
-    )
-    status = models.CharField(
-        max_length=20, choices=MessageStatus.choices, default=MessageStatus.DELIVERED
+        User, on_delete=models.CASCADE, related_name="room_presence"
     )
-    timestamp = models.DateTimeField(auto_now=True)
+    channel_name = models.CharField(max_length=255)
+    expires = models.DateTimeField(db_index=True)
 
     class Meta:
-        unique_together = ["message", "user"]
-        get_latest_by = "timestamp"
+        unique_together = ["channel_name", "room"]
+        indexes = [models.Index(fields=["room", "user", "expires"])]
@@ -0,0 +1,216 @@
+"""
+Message persistence for ChatConsumer.
+
+The backend is selected with the CHAT_PERSISTENCE setting:
+
+    CHAT_PERSISTENCE = {
+        "BACKEND": "apps.chat.persistence.WriteBehindPersistence",
+        "FLUSH_INTERVAL": 0.005,
+        "MAX_BATCH": 100,
+    }
+
+DirectPersistence writes every message in its own transaction on the
+database thread pool. WriteBehindPersistence queues the messages of all
+consumers in the process and writes them in group commits: one
+transaction, one multi-row INSERT and one watermark UPDATE per room for
+up to MAX_BATCH messages, flushed at most FLUSH_INTERVAL seconds after the
+first message of a batch was queued.
+
+For both backends:
+
+- Ack: ``await persistence.save(...)`` returns the saved Message only once
+  the transaction containing it has committed. Consumers broadcast after
+  that, so every message a client sees exists in the database.
+- Hops: DirectPersistence does all the work for a message, including the
+  presence lookup, in one thread-pool hop; WriteBehindPersistence shares
+  one hop between all messages of a batch.
+- Ordering: messages are written, and get their ids, in the order in which
+  ``save`` was called in the process. A consumer awaits each save before
+  reading its next frame, so per-connection order is preserved.
+- Failure: when a transaction fails, ``save`` raises for every message of
+  the batch and none of them is written or broadcast. Nothing is retried;
+  the sender is told and may resend.
+- A message whose sender disconnects while it is queued is still written,
+  but is not broadcast; clients see it when they next load the history.
+"""
+
+import asyncio
+import weakref
+from collections import defaultdict
+from functools import lru_cache
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+from .models import Message, Room, RoomWatermark
+
+DEFAULT_PERSISTENCE = {
+    "BACKEND": "apps.chat.persistence.DirectPersistence",
+    "FLUSH_INTERVAL": 0.005,
+    "MAX_BATCH": 100,
+}
+
+
+class BasePersistence:
+    def __init__(self, flush_interval=0.005, max_batch=100):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+    async def save(self, room_id, sender_id, content, presence, recipient_ids):
+        """
+        Persist a message and mark it delivered to those of ``recipient_ids``
+        that ``presence`` reports online; returns the Message once committed
+        """
+        raise NotImplementedError
+
+
+class DirectPersistence(BasePersistence):
+    """One transaction per message"""
+
+    async def save(self, room_id, sender_id, content, presence, recipient_ids):
+        return await database_sync_to_async(self.write)(
+            room_id, sender_id, content, presence, recipient_ids
+        )
+
+    @staticmethod
+    def write(room_id, sender_id, content, presence, recipient_ids):
+        online_ids = presence.online(room_id, recipient_ids)
+        message = Message(room_id=room_id, sender_id=sender_id, content=content)
+        # Recorded in the MESSAGE event instead of a STATUS event
+        message.delivered_to = online_ids
+        with transaction.atomic():
+            message.save()
+            if online_ids:
+                RoomWatermark.advance(
+                    room_id, online_ids, delivered=message.id, log=False
+                )
+        return message
+
+
+class WriteBehindPersistence(BasePersistence):
+    """Group commits of the messages queued by all consumers of the process"""
+
+    def __init__(self, flush_interval=0.005, max_batch=100):
+        super().__init__(flush_interval, max_batch)
+        # Futures belong to an event loop, so each loop gets its own queue
+        self.queues = weakref.WeakKeyDictionary()
+
+    async def save(self, room_id, sender_id, content, presence, recipient_ids):
+        loop = asyncio.get_running_loop()
+        queue = self.queues.get(loop)
+        if queue is None:
+            queue = self.queues[loop] = WriteBehindQueue(self)
+        return await queue.submit(room_id, sender_id, content, presence, recipient_ids)
+
+    @staticmethod
+    def write(batch):
+        """
+        Write a batch of (room_id, sender_id, content, presence,
+        recipient_ids) in one transaction and return the saved messages in
+        the same order
+        """
+        # Messages of a room to the same recipients share a presence lookup
+        online = {}
+        for room_id, _, _, presence, recipient_ids in batch:
+            key = (room_id, frozenset(recipient_ids))
+            if key not in online:
+                online[key] = presence.online(room_id, recipient_ids)
+
+        with transaction.atomic():
+            messages = []
+            for room_id, sender_id, content, _, recipient_ids in batch:
+                message = Message(room_id=room_id, sender_id=sender_id, content=content)
+                # Recorded in the MESSAGE events instead of STATUS events
+                message.delivered_to = online[(room_id, frozenset(recipient_ids))]
+                messages.append(message)
+            if connection.features.can_return_rows_from_bulk_insert:
+                Message.objects.bulk_create(messages)
+                by_room = defaultdict(list)
+                for message in messages:
+                    by_room[message.room_id].append(message)
+                for room_id, room_messages in by_room.items():
+                    Room.record_messages(room_id, room_messages)
+            else:
+                # Without ids from a bulk INSERT (MySQL), keep the single
+                # commit but insert row by row; save() maintains the Room
+                for message in messages:
+                    message.save()
+
+            # Each member's delivered watermark moves to the newest message
+            # they were online for; members sharing a target share an UPDATE
+            delivered = defaultdict(dict)
+            for message in messages:
+                for user_id in message.delivered_to:
+                    delivered[message.room_id][user_id] = message.id
+            for room_id, upto in delivered.items():
+                user_ids = defaultdict(list)
+                for user_id, message_id in upto.items():
+                    user_ids[message_id].append(user_id)
+                for message_id, members in user_ids.items():
+                    RoomWatermark.advance(
+                        room_id, members, delivered=message_id, log=False
+                    )
+        return messages
+
+
+class WriteBehindQueue:
+    """Pending messages of one event loop and the task that flushes them"""
+
+    def __init__(self, persistence):
+        self.persistence = persistence
+        self.pending = []
+        self.full = asyncio.Event()
+        self.flusher = None
+
+    def submit(self, room_id, sender_id, content, presence, recipient_ids):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(
+            ((room_id, sender_id, content, presence, recipient_ids), future)
+        )
+        if len(self.pending) >= self.persistence.max_batch:
+            self.full.set()
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush_pending())
+        # Shield the write from a cancelled consumer; the message is queued
+        return asyncio.shield(future)
+
+    async def flush_pending(self):
+        # Batches are written one after the other, which keeps id order equal
+        # to submission order and lets the next batch fill up meanwhile
+        while self.pending:
+            try:
+                await asyncio.wait_for(
+                    self.full.wait(), self.persistence.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+
+            batch = self.pending[: self.persistence.max_batch]
+            del self.pending[: self.persistence.max_batch]
+            if len(self.pending) < self.persistence.max_batch:
+                self.full.clear()
+
+            try:
+                messages = await database_sync_to_async(self.persistence.write)(
+                    [item for item, _ in batch]
+                )
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+            else:
+                for message, (_, future) in zip(messages, batch):
+                    if not future.done():
+                        future.set_result(message)
+
+
+@lru_cache
+def get_persistence():
+    """Return the process-wide message persistence configured in settings"""
+    config = {**DEFAULT_PERSISTENCE, **getattr(settings, "CHAT_PERSISTENCE", {})}
+    backend = import_string(config["BACKEND"])
+    return backend(
+        flush_interval=config["FLUSH_INTERVAL"], max_batch=config["MAX_BATCH"]
+    )
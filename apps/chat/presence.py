@@ -0,0 +1,126 @@
+"""
+Presence registry for chat rooms.
+
+Tracks which users have an open connection to a room. Every room a websocket
+connection is subscribed to is registered under its channel name and must
+heartbeat within TTL seconds, so entries left behind by a crashed worker
+expire on their own. The backend is selected with the CHAT_PRESENCE setting:
+
+    CHAT_PRESENCE = {
+        "BACKEND": "apps.chat.presence.DatabasePresence",
+        "TTL": 60,
+    }
+
+InMemoryPresence only sees connections of the current process.
+DatabasePresence shares state through the project database, so it is
+correct with several daphne workers on one or more nodes.
+"""
+
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import RoomPresence
+
+DEFAULT_PRESENCE = {
+    "BACKEND": "apps.chat.presence.InMemoryPresence",
+    "TTL": 60,
+}
+
+
+class BasePresence:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+
+    def connect(self, room_id, user_id, channel_name):
+        raise NotImplementedError
+
+    def heartbeat(self, room_id, user_id, channel_name):
+        raise NotImplementedError
+
+    def disconnect(self, room_id, user_id, channel_name):
+        raise NotImplementedError
+
+    def online(self, room_id, user_ids):
+        """Return the subset of user_ids that are connected to the room"""
+        raise NotImplementedError
+
+
+class InMemoryPresence(BasePresence):
+    def __init__(self, ttl=60):
+        super().__init__(ttl)
+        self.lock = threading.Lock()
+        # room_id -> {channel_name: (user_id, expires)}
+        self.rooms = {}
+
+    def connect(self, room_id, user_id, channel_name):
+        with self.lock:
+            channels = self.rooms.setdefault(str(room_id), {})
+            channels[channel_name] = (user_id, time.monotonic() + self.ttl)
+
+    def heartbeat(self, room_id, user_id, channel_name):
+        self.connect(room_id, user_id, channel_name)
+
+    def disconnect(self, room_id, user_id, channel_name):
+        with self.lock:
+            channels = self.rooms.get(str(room_id), {})
+            channels.pop(channel_name, None)
+            if not channels:
+                self.rooms.pop(str(room_id), None)
+
+    def online(self, room_id, user_ids):
+        user_ids = set(user_ids)
+        now = time.monotonic()
+        with self.lock:
+            channels = self.rooms.get(str(room_id), {})
+            expired = [
+                name for name, (_, expires) in channels.items() if expires <= now
+            ]
+            for name in expired:
+                del channels[name]
+            return {user_id for user_id, _ in channels.values() if user_id in user_ids}
+
+
+class DatabasePresence(BasePresence):
+    def expires(self):
+        return timezone.now() + timedelta(seconds=self.ttl)
+
+    def connect(self, room_id, user_id, channel_name):
+        RoomPresence.objects.filter(expires__lte=timezone.now()).delete()
+        RoomPresence.objects.update_or_create(
+            room_id=room_id,
+            channel_name=channel_name,
+            defaults={"user_id": user_id, "expires": self.expires()},
+        )
+
+    def heartbeat(self, room_id, user_id, channel_name):
+        updated = RoomPresence.objects.filter(
+            room_id=room_id, channel_name=channel_name
+        ).update(expires=self.expires())
+        if not updated:
+            self.connect(room_id, user_id, channel_name)
+
+    def disconnect(self, room_id, user_id, channel_name):
+        RoomPresence.objects.filter(room_id=room_id, channel_name=channel_name).delete()
+
+    def online(self, room_id, user_ids):
+        return set(
+            RoomPresence.objects.filter(
+                room_id=room_id, user_id__in=user_ids, expires__gt=timezone.now()
+            )
+            .values_list("user_id", flat=True)
+            .distinct()
+        )
+
+
+@lru_cache(maxsize=None)
+def get_presence():
+    """Return the process-wide presence registry configured in settings"""
+    config = {**DEFAULT_PRESENCE, **getattr(settings, "CHAT_PRESENCE", {})}
+    backend = import_string(config["BACKEND"])
+    return backend(ttl=config["TTL"])
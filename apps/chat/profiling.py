@@ -0,0 +1,314 @@
+"""
+On-demand sampling profiler for HTTP requests and websocket frames.
+
+Profiling is configured with the CHAT_PROFILING setting:
+
+    CHAT_PROFILING = {
+        "DIR": "/var/tmp/chat-profiles",
+        "INTERVAL": 0.005,
+    }
+
+Without a DIR the middleware removes itself at startup and consumers skip
+the check, so nothing is added to any request. With a DIR, staff turn
+profiling on and off with ``python manage.py profile_chat``, which writes
+the rules (users, path prefixes, rate, expiry) to DIR/rules.json. Every
+process looks at that file at most once per RELOAD_INTERVAL; while there
+are no rules, deciding not to profile costs a clock read and a comparison.
+
+A chosen request or frame is profiled from start to end: a sampler thread
+records the Python stack of every busy thread of the process each
+INTERVAL seconds and the stacks are written to DIR as collapsed stacks,
+one "thread;outer;...;inner count" line per distinct stack, ready for
+flamegraph.pl, speedscope or inferno. Sample counts are proportional to
+wall-clock time; the file name carries the duration of the request or
+frame. Database calls, template rendering and other
+synchronous work run in thread pool threads; sampling all threads shows
+them next to the event loop. The flip side is that the work of requests
+running concurrently in the same process shows up too, which is why
+rules should be narrow on a busy process.
+"""
+
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+DEFAULT_PROFILING = {
+    "DIR": "",
+    "INTERVAL": 0.005,
+}
+
+# Seconds between checks of the rules file
+RELOAD_INTERVAL = 1.0
+
+# Innermost frames of threads waiting for work: the event loop in select(),
+# thread pool workers on their queue, anything blocked on a Condition
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+    ("threading.py", "wait"),
+}
+
+
+class Rules:
+    """
+    What to profile: requests and frames whose path starts with one of
+    `paths` (any path if empty), made by one of `users` (anyone if empty),
+    `rate` of those at random, at most `limit` per process, until the
+    `until` timestamp
+    """
+
+    def __init__(self, until, users=(), paths=(), rate=1.0, limit=100):
+        self.until = until
+        self.users = set(users)
+        self.paths = tuple(paths)
+        self.rate = rate
+        self.remaining = limit
+
+    def covers(self, path):
+        """Whether the path is profiled, before looking at the user"""
+        return time.time() < self.until and (
+            not self.paths or path.startswith(self.paths)
+        )
+
+    def choose(self, username):
+        """Whether to profile a covered request or frame of this user"""
+        if self.users and username not in self.users:
+            return False
+        if self.remaining <= 0 or random.random() >= self.rate:
+            return False
+        self.remaining -= 1
+        return True
+
+
+class RulesFile:
+    """The rules in DIR/rules.json, re-read when the file changes"""
+
+    def __init__(self, directory):
+        self.path = Path(directory) / "rules.json"
+        self.rules = None
+        self.mtime = None
+        self.next_check = 0.0
+
+    def current(self):
+        """The rules in force, or None while profiling is off"""
+        now = time.monotonic()
+        if now >= self.next_check:
+            self.next_check = now + RELOAD_INTERVAL
+            self.reload()
+        return self.rules
+
+    def reload(self):
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            self.rules = self.mtime = None
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            with open(self.path) as rules_file:
+                self.rules = Rules(**json.load(rules_file))
+        except (OSError, ValueError, TypeError):
+            # Half-written or hand-edited; profiling stays off until fixed
+            self.rules = None
+
+    def write(self, **rules):
+        """Replace the rules for all processes sharing the directory"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_suffix(".tmp")
+        with open(temporary, "w") as rules_file:
+            json.dump(rules, rules_file)
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+
+class Sampler:
+    """Samples the stacks of all threads while any profile is running"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.base_dir = str(settings.BASE_DIR) + os.sep
+        self.profiles = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        # code object -> frame name in the collapsed output
+        self.names = {}
+
+    def add(self, profile):
+        with self.lock:
+            self.profiles.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="chat-profiler", daemon=True
+                )
+                self.thread.start()
+
+    def remove(self, profile):
+        with self.lock:
+            self.profiles.discard(profile)
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while True:
+            with self.lock:
+                if not self.profiles:
+                    self.thread = None
+                    return
+                threads = {
+                    thread.ident: thread.name for thread in threading.enumerate()
+                }
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    stack = self.collapse(frame)
+                    if stack is None:
+                        continue
+                    stack = f"{threads.get(ident, ident)};{stack}"
+                    for profile in self.profiles:
+                        profile.samples[stack] += 1
+            time.sleep(self.interval)
+
+    def collapse(self, frame):
+        """The stack as "outer;...;inner", or None if the thread is idle"""
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+            return None
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = self.names.get(code)
+            if name is None:
+                name = self.names[code] = self.frame_name(code)
+            names.append(name)
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def frame_name(self, code):
+        """function (file:line), the file relative to the project or site-packages"""
+        filename = code.co_filename
+        if filename.startswith(self.base_dir):
+            filename = filename[len(self.base_dir) :]
+        elif "site-packages" + os.sep in filename:
+            filename = filename.split("site-packages" + os.sep, 1)[1]
+        else:
+            filename = os.path.basename(filename)
+        # ";" separates the frames of a collapsed stack
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+class Profile:
+    """Context manager sampling the process while a request or frame runs"""
+
+    def __init__(self, profiler, label):
+        self.profiler = profiler
+        self.label = label
+        self.samples = Counter()
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.profiler.sampler.add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.sampler.remove(self)
+        if self.samples:
+            self.profiler.save(self, time.perf_counter() - self.started)
+
+
+class Profiler:
+    def __init__(self, directory, interval=0.005):
+        self.directory = Path(directory)
+        self.rules_file = RulesFile(directory)
+        self.sampler = Sampler(interval)
+
+    def rules(self, path):
+        """The rules in force if they cover the path, else None"""
+        rules = self.rules_file.current()
+        if rules is None or not rules.covers(path):
+            return None
+        return rules
+
+    def start(self, rules, username, label):
+        """A Profile if the rules choose this request or frame, else a no-op"""
+        if not rules.choose(username):
+            return nullcontext()
+        return Profile(self, label)
+
+    def save(self, profile, duration):
+        slug = re.sub(r"[^\w.-]+", "_", profile.label).strip("_")
+        filename = "{}-{}-{}-{:.0f}ms.collapsed".format(
+            datetime.now().strftime("%Y%m%dT%H%M%S.%f"),
+            os.getpid(),
+            slug,
+            duration * 1e3,
+        )
+        with open(self.directory / filename, "w") as output:
+            for stack, count in profile.samples.most_common():
+                output.write(f"{stack} {count}\n")
+
+
+@lru_cache
+def get_profiler():
+    """Return the process-wide profiler, or None if CHAT_PROFILING has no DIR"""
+    config = {**DEFAULT_PROFILING, **getattr(settings, "CHAT_PROFILING", {})}
+    if not config["DIR"]:
+        return None
+    return Profiler(config["DIR"], interval=config["INTERVAL"])
+
+
+class ProfilingMiddleware:
+    """
+    Profile the HTTP requests chosen by the profiling rules. Goes after
+    AuthenticationMiddleware, which provides the user, and before the
+    middleware whose time should be included, such as htmlmin's.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.profiler = get_profiler()
+        if self.profiler is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        rules = self.profiler.rules(request.path)
+        if rules is None:
+            return self.get_response(request)
+        # Only loaded, from the session, when the rules name users
+        username = request.user.get_username() if rules.users else None
+        with self.profiler.start(rules, username, self.label(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        rules = self.profiler.rules(request.path)
+        if rules is None:
+            return await self.get_response(request)
+        username = (await request.auser()).get_username() if rules.users else None
+        with self.profiler.start(rules, username, self.label(request)):
+            return await self.get_response(request)
+
+    def label(self, request):
+        return f"{request.method} {request.path}"
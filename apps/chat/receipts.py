@@ -0,0 +1,70 @@
+"""
+Debounced delivery/read status broadcasts.
+
+Acknowledgements only move watermarks; the room is told about the result
+at most once per CHAT_RECEIPT_INTERVAL seconds per process. Each broadcast
+is a status_update carrying the watermarks of the members who are furthest
+behind (RoomWatermark.lowest), at most four rows however large the room,
+so clients derive the status of all their messages from it no matter how
+many acks were coalesced into it.
+"""
+
+import asyncio
+import logging
+import time
+from functools import lru_cache
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .frames import group_event
+from .models import RoomWatermark
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiptBroadcaster:
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        # (event loop, room id) -> scheduled broadcast
+        self.scheduled = {}
+
+    def schedule(self, channel_layer, room_id):
+        """Broadcast the room's watermarks once the interval has passed"""
+        key = (asyncio.get_running_loop(), room_id)
+        if key not in self.scheduled:
+            self.scheduled[key] = asyncio.create_task(
+                self.broadcast_later(key, channel_layer, room_id)
+            )
+
+    async def broadcast_later(self, key, channel_layer, room_id):
+        try:
+            await asyncio.sleep(self.interval)
+        finally:
+            # Acks arriving from here on schedule the next broadcast
+            del self.scheduled[key]
+        try:
+            watermarks = await database_sync_to_async(RoomWatermark.for_room)(room_id)
+            started = time.perf_counter()
+            await channel_layer.group_send(
+                f"chat_{room_id}",
+                group_event(
+                    "status_update",
+                    room_id=room_id,
+                    watermarks=RoomWatermark.lowest(watermarks),
+                ),
+            )
+            metrics.LAYER_SEND_LATENCY.observe(
+                time.perf_counter() - started, "status_update"
+            )
+            metrics.FANOUT.observe(len(watermarks), "status_update")
+        except Exception:
+            # Nobody awaits this task; the next ack schedules a new broadcast
+            logger.exception("Broadcasting receipts of room %s failed", room_id)
+
+
+@lru_cache
+def get_receipts():
+    """Return the process-wide receipt broadcaster"""
+    return ReceiptBroadcaster(interval=getattr(settings, "CHAT_RECEIPT_INTERVAL", 0.25))
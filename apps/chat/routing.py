@@ -3,6 +3,8 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
+    re_path(r"ws/$", consumers.MultiplexConsumer.as_asgi()),
+    # Single-room and notification-only endpoints for older clients
     re_path(r"ws/chat/(?P<room_name>\w+)/$", consumers.ChatConsumer.as_asgi()),
     re_path(r"ws/notifications/$", consumers.ChatNotificationConsumer.as_asgi()),
 ]
@@ -0,0 +1,208 @@
+"""
+Full-text search over the messages of the rooms a user belongs to.
+
+The index depends on the database (see migration 0008_message_search):
+
+- SQLite: the FTS5 table chat_message_fts, kept in step with chat_message
+  by triggers, so every write path updates it, raw and bulk ones included.
+- MySQL: the InnoDB FULLTEXT index chat_message_content_fts. Which words
+  are indexed is up to the server's innodb_ft_min_token_size (default 3)
+  and stopword list.
+- Other backends have no index; the messages of the user's rooms are
+  scanned with LIKE.
+
+A query is reduced to its words and every word has to match; words of
+three or more characters also match as prefixes, so "depl" finds
+"deploy". Results are newest first and paged with the id of the oldest
+result as the `before` cursor.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+
+from .models import Message, Room
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+MAX_TERMS = 8
+# Words of context in a highlighted snippet
+SNIPPET_WORDS = 16
+# Placed around matches in snippets and turned into <mark> after escaping
+MARK_START, MARK_END = "\x02", "\x03"
+# Shorter words match whole words only; as prefixes they match too much
+MIN_PREFIX = 3
+
+
+def query_terms(query):
+    """The lower-cased words of a search query"""
+    return re.findall(r"\w+", query.lower())[:MAX_TERMS]
+
+
+def fts5_expression(terms):
+    # Quoted, so that words like NOT or NEAR are not operators
+    return " ".join(
+        f'"{term}"*' if len(term) >= MIN_PREFIX else f'"{term}"' for term in terms
+    )
+
+
+def boolean_mode_expression(terms):
+    return " ".join(
+        f"+{term}*" if len(term) >= MIN_PREFIX else f"+{term}" for term in terms
+    )
+
+
+def matching_ids(query):
+    """
+    Subquery of the ids of all messages matching a query, for filtering
+    querysets such as the admin's: Message.objects.filter(id__in=...)
+    """
+    terms = query_terms(query)
+    if connection.vendor == "sqlite":
+        return RawSQL(
+            "SELECT rowid FROM chat_message_fts WHERE chat_message_fts MATCH %s",
+            [fts5_expression(terms)],
+        )
+    if connection.vendor == "mysql":
+        return RawSQL(
+            "SELECT id FROM chat_message "
+            "WHERE MATCH (content) AGAINST (%s IN BOOLEAN MODE)",
+            [boolean_mode_expression(terms)],
+        )
+    messages = Message.objects.all()
+    for term in terms:
+        messages = messages.filter(content__icontains=term)
+    return messages.values("id")
+
+
+def find_sqlite(terms, rooms, before, limit):
+    """(id, snippet) of matches, newest first, snippets made by FTS5"""
+    rooms_sql, rooms_params = rooms.query.sql_with_params()
+    sql = f"""
+        SELECT f.rowid, snippet(chat_message_fts, 0, %s, %s, '…', %s)
+        FROM chat_message_fts f
+        INNER JOIN chat_message m ON m.id = f.rowid
+        WHERE chat_message_fts MATCH %s AND m.room_id IN ({rooms_sql})
+        {"AND f.rowid < %s" if before is not None else ""}
+        ORDER BY f.rowid DESC
+        LIMIT %s
+    """
+    params = [MARK_START, MARK_END, SNIPPET_WORDS, fts5_expression(terms)]
+    params += [*rooms_params, *([before] if before is not None else []), limit]
+    # Driven by the index in rowid order, so the LIMIT ends the search early
+    # and snippets are only made for the rows returned
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def find_mysql(terms, rooms, before, limit):
+    rooms_sql, rooms_params = rooms.query.sql_with_params()
+    sql = f"""
+        SELECT id FROM chat_message
+        WHERE MATCH (content) AGAINST (%s IN BOOLEAN MODE)
+        AND room_id IN ({rooms_sql})
+        {"AND id < %s" if before is not None else ""}
+        ORDER BY id DESC
+        LIMIT %s
+    """
+    params = [boolean_mode_expression(terms), *rooms_params]
+    params += [*([before] if before is not None else []), limit]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(message_id, None) for (message_id,) in cursor.fetchall()]
+
+
+def find_unindexed(terms, rooms, before, limit):
+    messages = Message.objects.filter(room_id__in=rooms)
+    for term in terms:
+        messages = messages.filter(content__icontains=term)
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    ids = messages.order_by("-id").values_list("id", flat=True)[:limit]
+    return [(message_id, None) for message_id in ids]
+
+
+def make_snippet(content, terms):
+    """The words around the first match, with every match marked"""
+    pattern = re.compile(
+        "|".join(
+            (
+                rf"\b{re.escape(term)}\w*"
+                if len(term) >= MIN_PREFIX
+                else rf"\b{re.escape(term)}\b"
+            )
+            for term in terms
+        ),
+        re.IGNORECASE,
+    )
+    words = content.split()
+    first = next((i for i, word in enumerate(words) if pattern.search(word)), 0)
+    start = max(0, min(first - SNIPPET_WORDS // 4, len(words) - SNIPPET_WORDS))
+    snippet = " ".join(words[start : start + SNIPPET_WORDS])
+    snippet = pattern.sub(lambda match: MARK_START + match[0] + MARK_END, snippet)
+    return (
+        ("…" if start > 0 else "")
+        + snippet
+        + ("…" if start + SNIPPET_WORDS < len(words) else "")
+    )
+
+
+def search(user, query, room_id=None, before=None, limit=PAGE_SIZE):
+    """
+    Return ([(message, snippet)], has_more) for the newest messages
+    matching the query in the user's rooms, or in one of them with
+    room_id, older than the message id `before` if given
+    """
+    terms = query_terms(query)
+    if not terms:
+        return [], False
+    rooms = Room.participants.through.objects.filter(user=user)
+    if room_id is not None:
+        rooms = rooms.filter(room_id=room_id)
+    find = {"sqlite": find_sqlite, "mysql": find_mysql}.get(
+        connection.vendor, find_unindexed
+    )
+    found = find(terms, rooms.values("room_id"), before, limit + 1)
+    has_more = len(found) > limit
+    found = found[:limit]
+
+    messages = Message.objects.select_related("sender").in_bulk(
+        [message_id for message_id, _ in found]
+    )
+    hits = [
+        (
+            messages[message_id],
+            snippet or make_snippet(messages[message_id].content, terms),
+        )
+        for message_id, snippet in found
+        # Unless deleted in the meantime
+        if message_id in messages
+    ]
+    return hits, has_more
+
+
+def highlight_html(snippet):
+    """A snippet as HTML with the matches in <mark> elements"""
+    return escape(snippet).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+
+def serialize_results(hits, has_more):
+    return {
+        "results": [
+            {
+                "message_id": message.id,
+                "room_id": message.room_id,
+                "message": message.content,
+                "sender_id": message.sender_id,
+                "sender_name": message.sender.username,
+                "timestamp": message.dtm_created.isoformat(),
+                "highlight": highlight_html(snippet),
+            }
+            for message, snippet in hits
+        ],
+        "before": hits[-1][0].id if hits else None,
+        "has_more": has_more,
+    }
@@ -0,0 +1,136 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .archive import get_archive
+from .models import Message, Room, RoomEvent, RoomEventKind, RoomWatermark
+
+
+def notify_room_changed(room_ids):
+    """Tell connected ChatConsumers to reload their cached room metadata"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    def broadcast():
+        for room_id in room_ids:
+            async_to_sync(channel_layer.group_send)(
+                f"chat_{room_id}", {"type": "room_changed", "room_id": room_id}
+            )
+
+    transaction.on_commit(broadcast)
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def sync_room_watermarks(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep one RoomWatermark per room participant"""
+    if action == "post_add":
+        if reverse:
+            for room_id in pk_set:
+                RoomWatermark.create_for_members(room_id, [instance.pk])
+        else:
+            RoomWatermark.create_for_members(instance.pk, pk_set)
+    elif action == "post_remove":
+        if reverse:
+            RoomWatermark.objects.filter(user=instance, room_id__in=pk_set).delete()
+        else:
+            RoomWatermark.objects.filter(room=instance, user_id__in=pk_set).delete()
+    elif action == "post_clear":
+        if reverse:
+            RoomWatermark.objects.filter(user=instance).delete()
+        else:
+            RoomWatermark.objects.filter(room=instance).delete()
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def log_membership_events(sender, instance, action, reverse, pk_set, **kwargs):
+    """Record joins and leaves in the rooms' event logs"""
+    if action in ("post_add", "post_remove"):
+        change = "joined" if action == "post_add" else "left"
+        if reverse:
+            for room_id in pk_set:
+                RoomEvent.append(
+                    room_id,
+                    RoomEventKind.MEMBERSHIP,
+                    [{"change": change, "user_ids": [instance.pk]}],
+                )
+        else:
+            RoomEvent.append(
+                instance.pk,
+                RoomEventKind.MEMBERSHIP,
+                [{"change": change, "user_ids": sorted(pk_set)}],
+            )
+    elif action == "pre_clear":
+        # The members are gone by post_clear, so log them beforehand
+        if reverse:
+            for room_id in instance.rooms.values_list("id", flat=True):
+                RoomEvent.append(
+                    room_id,
+                    RoomEventKind.MEMBERSHIP,
+                    [{"change": "left", "user_ids": [instance.pk]}],
+                )
+        else:
+            user_ids = list(instance.participants.values_list("id", flat=True))
+            if user_ids:
+                RoomEvent.append(
+                    instance.pk,
+                    RoomEventKind.MEMBERSHIP,
+                    [{"change": "left", "user_ids": user_ids}],
+                )
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def room_participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove"):
+        notify_room_changed(list(pk_set) if reverse else [instance.pk])
+    elif action == "pre_clear":
+        if reverse:
+            notify_room_changed(list(instance.rooms.values_list("id", flat=True)))
+        else:
+            notify_room_changed([instance.pk])
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, created, **kwargs):
+    if not created:
+        notify_room_changed([instance.pk])
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    """Remove the archived messages along with the room's table rows"""
+    room_id = instance.pk
+    transaction.on_commit(lambda: get_archive().delete_room(room_id))
+
+
+class RoomRefresh:
+    """Rooms that lost messages in the current transaction"""
+
+    def __init__(self):
+        self.room_ids = set()
+
+    def __call__(self):
+        for room in Room.objects.filter(pk__in=self.room_ids):
+            room.refresh_activity()
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    """
+    Recompute the denormalized message fields of the rooms once the deleting
+    transaction commits, once per room however many messages went
+    """
+    connection = transaction.get_connection()
+    refresh = getattr(connection, "chat_room_refresh", None)
+    scheduled = refresh is not None and any(
+        callback is refresh for _, callback, _ in connection.run_on_commit
+    )
+    if not scheduled:
+        # First deletion in this transaction, or the last one rolled back
+        refresh = connection.chat_room_refresh = RoomRefresh()
+    refresh.room_ids.add(instance.room_id)
+    if not scheduled:
+        # Runs right away outside a transaction
+        transaction.on_commit(refresh)
@@ -0,0 +1,96 @@
+from datetime import datetime
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+
+from apps.chat.models import ChatType, Message, Room
+
+User = get_user_model()
+
+
+class MessageDateHierarchyTests(TestCase):
+    """The choices span the first to the last message of the list"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser("admin", "", None)
+        room = Room.objects.create(
+            name="room", chat_type=ChatType.GROUP, creator=cls.admin
+        )
+        for day in (
+            datetime(2025, 11, 30, 12),
+            datetime(2026, 2, 1, 12),
+            datetime(2026, 4, 10, 12),
+        ):
+            message = Message.objects.create(room=room, sender=cls.admin, content="hi")
+            Message.objects.filter(pk=message.pk).update(
+                dtm_created=timezone.make_aware(day)
+            )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_years(self):
+        response = self.client.get("/admin/chat/message/")
+        self.assertContains(response, "?dtm_created__year=2025")
+        self.assertContains(response, "?dtm_created__year=2026")
+
+    def test_months_include_empty_ones(self):
+        response = self.client.get("/admin/chat/message/?dtm_created__year=2026")
+        for month in (2, 3, 4):
+            self.assertContains(response, f"dtm_created__month={month}&")
+        self.assertNotContains(response, "dtm_created__month=1&")
+        self.assertNotContains(response, "dtm_created__month=5&")
+
+    def test_days(self):
+        response = self.client.get(
+            "/admin/chat/message/?dtm_created__year=2025&dtm_created__month=11"
+        )
+        self.assertContains(response, "dtm_created__day=30")
+        self.assertNotContains(response, "dtm_created__day=29")
+
+    def test_no_messages(self):
+        Message.objects.all().delete()
+        response = self.client.get("/admin/chat/message/")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "dtm_created__year=")
+
+
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser("admin", "", None)
+        cls.dana = User.objects.create(username="Dana")
+        standup = Room.objects.create(
+            name="Standup", chat_type=ChatType.GROUP, creator=cls.admin
+        )
+        random = Room.objects.create(
+            name="random", chat_type=ChatType.GROUP, creator=cls.admin
+        )
+        cls.deploy = Message.objects.create(
+            room=random, sender=cls.admin, content="deploying now"
+        )
+        cls.by_dana = Message.objects.create(
+            room=random, sender=cls.dana, content="hello"
+        )
+        cls.in_standup = Message.objects.create(
+            room=standup, sender=cls.admin, content="morning"
+        )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def search(self, term):
+        response = self.client.get("/admin/chat/message/", {"q": term})
+        return {message.id for message in response.context["cl"].result_list}
+
+    def test_content_sender_and_room(self):
+        self.assertEqual(self.search("deploy"), {self.deploy.id})
+        self.assertEqual(self.search("dan"), {self.by_dana.id})
+        self.assertEqual(self.search("STAND"), {self.in_standup.id})
+        self.assertEqual(self.search("nothing"), set())
+
+    def test_prefix_matches_only(self):
+        self.assertEqual(self.search("ana"), set())
+        self.assertEqual(self.search("andup"), set())
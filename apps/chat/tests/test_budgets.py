@@ -0,0 +1,34 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from apps.chat.budgets import explain
+from apps.chat.models import Message
+
+
+@skipUnless(connection.vendor == "sqlite", "SQLite query plans")
+class ExplainSqliteTests(TestCase):
+    def scans(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        return explain({"sql": sql, "params": params, "many": False})["scans"]
+
+    def test_limited_scan_without_where(self):
+        self.assertEqual(self.scans(Message.objects.order_by("-id")[:5]), set())
+
+    def test_limited_index_scan_covering_where(self):
+        messages = Message.objects.filter(dtm_created__lt=timezone.now())
+        self.assertEqual(
+            self.scans(messages.order_by("room_id", "dtm_created")[:5]), set()
+        )
+
+    def test_limited_index_scan_filtering_other_columns(self):
+        messages = Message.objects.filter(content="hello")
+        self.assertEqual(
+            self.scans(messages.order_by("room_id", "dtm_created")[:5]),
+            {"chat_message"},
+        )
+
+    def test_unlimited_scan(self):
+        self.assertEqual(self.scans(Message.objects.all()), {"chat_message"})
@@ -0,0 +1,173 @@
+import base64
+import io
+import tempfile
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.chat.archive import get_archive, open_segment
+from apps.chat.history import decode_cursor, encode_cursor, get_page
+from apps.chat.models import ChatType, Message, Room
+
+User = get_user_model()
+
+
+class HistoryPagingTests(TestCase):
+    """Pages cover the history exactly once, whichever way they are read"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username="alice")
+        cls.room = Room.objects.create(
+            name="room", chat_type=ChatType.GROUP, creator=cls.alice
+        )
+        cls.room.participants.add(cls.alice)
+        start = timezone.now() - timedelta(days=400)
+        cls.messages = []
+        # Runs of three messages share a timestamp; ids do not follow time
+        for index in range(12):
+            message = Message.objects.create(
+                room=cls.room, sender=cls.alice, content=str(index)
+            )
+            Message.objects.filter(pk=message.pk).update(
+                dtm_created=start + timedelta(minutes=(11 - index) // 3)
+            )
+            cls.messages.append(Message.objects.get(pk=message.pk))
+        cls.messages.sort(key=lambda message: (message.dtm_created, message.id))
+        cls.room.refresh_activity()
+        cls.expected = [message.id for message in cls.messages]
+
+    def page_backwards(self, limit):
+        """Ids from newest to oldest page, and has_more of each page"""
+        ids, flags, before = [], [], None
+        while True:
+            page, has_more = get_page(self.room.id, before=before, limit=limit)
+            ids[:0] = [message.id for message in page]
+            flags.append(has_more)
+            if not has_more:
+                return ids, flags
+            before = encode_cursor(page[0])
+
+    def page_forwards(self, limit):
+        """Ids from the oldest page on, and has_more of each page"""
+        page, _ = get_page(self.room.id, limit=len(self.expected))
+        after = encode_cursor(page[0])
+        ids, flags = [page[0].id], []
+        while True:
+            page, has_more = get_page(self.room.id, after=after, limit=limit)
+            ids += [message.id for message in page]
+            flags.append(has_more)
+            if not has_more:
+                return ids, flags
+            after = encode_cursor(page[-1])
+
+    def assertPaging(self, limit):
+        ids, flags = self.page_backwards(limit)
+        self.assertEqual(ids, self.expected)
+        pages = -(-len(self.expected) // limit)
+        self.assertEqual(flags, [True] * (pages - 1) + [False])
+
+        ids, flags = self.page_forwards(limit)
+        self.assertEqual(ids, self.expected)
+        pages = -(-(len(self.expected) - 1) // limit)
+        self.assertEqual(flags, [True] * (pages - 1) + [False])
+
+    def test_equal_timestamps(self):
+        self.assertTrue(
+            any(
+                a.dtm_created == b.dtm_created
+                for a, b in zip(self.messages, self.messages[1:])
+            )
+        )
+        for limit in (1, 2, 3, 4, 5, 11, 12):
+            with self.subTest(limit=limit):
+                self.assertPaging(limit)
+
+    def test_has_more_at_page_edges(self):
+        # Exactly one page left is not "more"
+        page, has_more = get_page(self.room.id, limit=12)
+        self.assertEqual(len(page), 12)
+        self.assertFalse(has_more)
+        page, has_more = get_page(self.room.id, limit=11)
+        self.assertEqual(page[0].id, self.expected[1])
+        self.assertTrue(has_more)
+
+        page, has_more = get_page(self.room.id, before=encode_cursor(self.messages[0]))
+        self.assertEqual((page, has_more), ([], False))
+        page, has_more = get_page(self.room.id, after=encode_cursor(self.messages[-1]))
+        self.assertEqual((page, has_more), ([], False))
+        page, has_more = get_page(
+            self.room.id, after=encode_cursor(self.messages[-3]), limit=2
+        )
+        self.assertEqual([message.id for message in page], self.expected[-2:])
+        self.assertFalse(has_more)
+
+    def test_across_archive_boundary(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(CHAT_ARCHIVE={"DIR": directory}):
+                get_archive.cache_clear()
+                open_segment.cache_clear()
+                try:
+                    # Segments of four split runs of equal timestamps, and
+                    # the room's last message stays in the table
+                    call_command(
+                        "archive_messages",
+                        room=[self.room.id],
+                        days=30,
+                        segment_size=4,
+                        stdout=io.StringIO(),
+                    )
+                    self.assertEqual(
+                        list(Message.objects.filter(room=self.room)),
+                        [self.messages[-1]],
+                    )
+                    self.assertEqual(len(get_archive().room(self.room.id).paths), 3)
+                    for limit in (1, 3, 5, 12):
+                        with self.subTest(limit=limit):
+                            self.assertPaging(limit)
+                finally:
+                    get_archive.cache_clear()
+                    open_segment.cache_clear()
+
+
+def cursor(value):
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+class DecodeCursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        message = Message(id=7, dtm_created=timezone.now())
+        self.assertEqual(
+            decode_cursor(encode_cursor(message)), (message.dtm_created, 7)
+        )
+
+    def test_invalid(self):
+        for value in (
+            "not base64!",
+            cursor("2026-10-18T08:00:00+00:00"),
+            cursor("yesterday|7"),
+            cursor("2026-10-18T08:00:00+00:00|seven"),
+            # Naive times cannot be compared with the stored ones
+            cursor("2026-10-18T08:00:00|7"),
+        ):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                decode_cursor(value)
+
+
+class MessageHistoryViewTests(TestCase):
+    def test_naive_cursor_is_rejected(self):
+        alice = User.objects.create(username="alice")
+        room = Room.objects.create(name="room", chat_type=ChatType.GROUP, creator=alice)
+        room.participants.add(alice)
+        self.client.force_login(alice)
+        url = reverse("chat:history", args=[room.id])
+        for direction in ("before", "after"):
+            with self.subTest(direction=direction):
+                response = self.client.get(
+                    url, {direction: cursor("2026-10-18T08:00:00|7")}
+                )
+                self.assertEqual(response.status_code, 400)
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import stat
+import tempfile
+from unittest import mock
+
+from channels.exceptions import ChannelFull
+from django.test import SimpleTestCase
+
+from apps.chat.ipc import IPCChannelLayer
+from apps.chat.layers import COALESCE, DISCONNECT, DROP_OLDEST, ChatChannelLayer
+
+
+def message(kind, number):
+    return {"type": kind, "number": number}
+
+
+class ChatChannelLayerTests(SimpleTestCase):
+    channel = "specific..chat!test"
+
+    def queued(self, layer, channel=None):
+        buffer = layer.channels.get(channel or self.channel)
+        return [queued for _, queued in buffer.messages] if buffer else []
+
+    async def fill(self, layer, *messages):
+        for queued in messages:
+            await layer.send(self.channel, queued)
+
+    async def test_drop_oldest_evicts_head(self):
+        layer = ChatChannelLayer(capacity=2, overflow=DROP_OLDEST)
+        await self.fill(
+            layer,
+            message("chat_message", 1),
+            message("chat_message", 2),
+            message("chat_message", 3),
+        )
+
+        self.assertEqual(
+            self.queued(layer),
+            [message("chat_message", 2), message("chat_message", 3)],
+        )
+        self.assertEqual(layer.stats["dropped"], 1)
+        self.assertEqual(await layer.receive(self.channel), message("chat_message", 2))
+
+    async def test_coalesce_evicts_status_updates_first(self):
+        layer = ChatChannelLayer(capacity=3, overflow=COALESCE)
+        await self.fill(
+            layer,
+            message("chat_message", 1),
+            message("status_update", 2),
+            message("chat_message", 3),
+            message("chat_message", 4),
+        )
+
+        self.assertEqual(
+            self.queued(layer),
+            [
+                message("chat_message", 1),
+                message("chat_message", 3),
+                message("chat_message", 4),
+            ],
+        )
+        self.assertEqual(layer.stats["coalesced"], 1)
+
+    async def test_coalesce_full_of_messages(self):
+        layer = ChatChannelLayer(capacity=2, overflow=COALESCE)
+        await self.fill(layer, message("chat_message", 1), message("chat_message", 2))
+
+        # A status update with nothing to evict is dropped quietly ...
+        await layer.send(self.channel, message("status_update", 3))
+        self.assertEqual(layer.stats["coalesced"], 1)
+        # ... anything else is refused
+        with self.assertRaises(ChannelFull):
+            await layer.send(self.channel, message("chat_message", 4))
+
+        self.assertEqual(
+            self.queued(layer),
+            [message("chat_message", 1), message("chat_message", 2)],
+        )
+        self.assertEqual(layer.stats["dropped"], 1)
+
+    async def test_disconnect_queues_overflow_event(self):
+        layer = ChatChannelLayer(capacity=2, overflow=DISCONNECT)
+        await layer.group_add("room_1", self.channel)
+        for number in range(3):
+            await layer.group_send("room_1", message("chat_message", number))
+
+        self.assertEqual(self.queued(layer), [{"type": "layer.overflow"}])
+        self.assertEqual(layer.stats["disconnected"], 1)
+        self.assertNotIn("room_1", layer.groups)
+        self.assertNotIn(self.channel, layer.channel_groups)
+
+        # The channel no longer receives group messages
+        await layer.group_send("room_1", message("chat_message", 3))
+        self.assertEqual(await layer.receive(self.channel), {"type": "layer.overflow"})
+
+    async def test_expired_messages_dropped_when_touched(self):
+        layer = ChatChannelLayer(expiry=10)
+        other = "specific..chat!other"
+        await layer.group_add("room_1", self.channel)
+        with mock.patch("apps.chat.layers.time.time", return_value=1000):
+            await self.fill(layer, message("chat_message", 1))
+            await layer.send(other, message("chat_message", 2))
+
+        with mock.patch("apps.chat.layers.time.time", return_value=1011):
+            await layer.send(self.channel, message("chat_message", 3))
+            # Only the channel that was touched has been expired
+            self.assertEqual(self.queued(layer), [message("chat_message", 3)])
+            self.assertEqual(self.queued(layer, other), [message("chat_message", 2)])
+            self.assertEqual(layer.stats["expired"], 1)
+            # A channel that let messages expire stops receiving group sends
+            self.assertNotIn(self.channel, layer.channel_groups)
+
+    async def test_flush_keeps_waiting_receivers(self):
+        layer = ChatChannelLayer()
+        await layer.group_add("room_1", self.channel)
+        await layer.send("specific..chat!idle", message("chat_message", 1))
+        receiver = asyncio.create_task(layer.receive(self.channel))
+        await asyncio.sleep(0)
+
+        await layer.flush()
+        self.assertEqual(list(layer.channels), [self.channel])
+        self.assertEqual(layer.groups, {})
+
+        await layer.send(self.channel, message("chat_message", 2))
+        received = await asyncio.wait_for(receiver, timeout=1)
+        self.assertEqual(received, message("chat_message", 2))
+        self.assertEqual(layer.queue_depth(), 0)
+
+
+class IPCChannelLayerDirectoryTests(SimpleTestCase):
+    def setUp(self):
+        self.parent = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.parent.name, "layer")
+
+    def tearDown(self):
+        self.parent.cleanup()
+
+    def test_path_required(self):
+        with self.assertRaises(ValueError):
+            IPCChannelLayer()
+
+    def test_directory_created_private(self):
+        IPCChannelLayer(path=self.path)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o700)
+
+    def test_shared_directory_refused(self):
+        os.mkdir(self.path)
+        os.chmod(self.path, 0o770)
+        with self.assertRaises(PermissionError):
+            IPCChannelLayer(path=self.path)
+
+    def test_foreign_directory_refused(self):
+        os.mkdir(self.path, 0o700)
+        with mock.patch("apps.chat.ipc.os.getuid", return_value=os.getuid() + 1):
+            with self.assertRaises(PermissionError):
+                IPCChannelLayer(path=self.path)
@@ -0,0 +1,66 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.test import TestCase
+
+from apps.chat.models import ChatType, Message, Room
+from apps.chat.signals import RoomRefresh
+
+User = get_user_model()
+
+
+class MessageDeletedTests(TestCase):
+    """Deleting messages refreshes each affected room once, on commit"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create(username=name) for name in ("alice", "bob")
+        ]
+        cls.rooms = [
+            Room.objects.create(name=name, chat_type=ChatType.GROUP, creator=cls.alice)
+            for name in ("first", "second")
+        ]
+        for room in cls.rooms:
+            room.participants.add(cls.alice, cls.bob)
+            Message.objects.create(room=room, sender=cls.alice, content="alice")
+            Message.objects.create(room=room, sender=cls.bob, content="bob")
+
+    def refreshes(self, callbacks):
+        return [callback for callback in callbacks if isinstance(callback, RoomRefresh)]
+
+    def assertRoom(self, room, last_message, count):
+        room.refresh_from_db()
+        self.assertEqual(room.last_message, last_message)
+        self.assertEqual(room.message_count, count)
+        self.assertEqual(
+            room.last_activity, last_message.dtm_created if last_message else None
+        )
+
+    def test_cascade_refreshes_each_room_once(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.bob.delete()
+        self.assertEqual(len(self.refreshes(callbacks)), 1)
+        for room in self.rooms:
+            self.assertRoom(room, room.messages.get(sender=self.alice), 1)
+
+    def test_queryset_delete(self):
+        first, second = self.rooms
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(room=first).delete()
+        self.assertRoom(first, None, 0)
+        self.assertRoom(second, second.messages.latest("id"), 2)
+
+    def test_rolled_back_deletion(self):
+        room = self.rooms[0]
+        last_message = room.messages.latest("id")
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    Message.objects.filter(pk=last_message.pk).delete()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            # A later deletion schedules a refresh of its own
+            room.messages.exclude(pk=last_message.pk).delete()
+        self.assertEqual(len(self.refreshes(callbacks)), 1)
+        self.assertRoom(room, last_message, 1)
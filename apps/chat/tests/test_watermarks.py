@@ -0,0 +1,153 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+
+from apps.chat.models import ChatType, Message, MessageStatus, Room, RoomWatermark
+
+User = get_user_model()
+
+
+class ReceiptMigrationTests(TransactionTestCase):
+    """0002 collapses receipts into watermarks and expands them back"""
+
+    before = [("chat", "0001_initial")]
+    after = [("chat", "0002_roomwatermark")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def setUp(self):
+        apps = self.migrate(self.before)
+        Room = apps.get_model("chat", "Room")
+        Message = apps.get_model("chat", "Message")
+        MessageReceipt = apps.get_model("chat", "MessageReceipt")
+        HistoricalUser = apps.get_model(*User._meta.label.split("."))
+
+        self.sender = HistoricalUser.objects.create(username="sender")
+        self.recipient = HistoricalUser.objects.create(username="recipient")
+        room = Room.objects.create(
+            name="room", chat_type=ChatType.GROUP, creator=self.sender
+        )
+        room.participants.add(self.sender, self.recipient)
+        self.room_id = room.id
+        self.message_ids = [
+            Message.objects.create(room=room, sender=self.sender, content=str(i)).id
+            for i in range(4)
+        ]
+        # Read, delivered, read out of order, still only sent
+        for message_id, status in zip(
+            self.message_ids, ["read", "delivered", "read", "sent"]
+        ):
+            MessageReceipt.objects.create(
+                message_id=message_id, user=self.recipient, status=status
+            )
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def watermarks(self, apps):
+        return {
+            user_id: (delivered, read)
+            for user_id, delivered, read in apps.get_model(
+                "chat", "RoomWatermark"
+            ).objects.values_list("user_id", "last_delivered_id", "last_read_id")
+        }
+
+    def test_forward(self):
+        apps = self.migrate(self.after)
+        first, second, third, fourth = self.message_ids
+        self.assertEqual(
+            self.watermarks(apps),
+            {
+                # Just below the first message that did not reach the state
+                self.recipient.id: (third, first),
+                # Without receipts everything up to the latest message
+                self.sender.id: (fourth, fourth),
+            },
+        )
+
+    def test_backward(self):
+        self.migrate(self.after)
+        apps = self.migrate(self.before)
+        receipts = apps.get_model("chat", "MessageReceipt").objects
+        first, second, third, fourth = self.message_ids
+        self.assertEqual(
+            dict(
+                receipts.filter(user_id=self.recipient.id).values_list(
+                    "message_id", "status"
+                )
+            ),
+            # The third message was read out of order, which the watermark
+            # cannot represent, so it comes back as delivered
+            {first: "read", second: "delivered", third: "delivered", fourth: "sent"},
+        )
+        # Nobody gets receipts for their own messages
+        self.assertFalse(receipts.filter(user_id=self.sender.id).exists())
+
+
+class FloorStatusTests(TestCase):
+    """A message's overall status is decided by the members other than its sender"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create(username=name) for name in ("alice", "bob", "carol")
+        ]
+        cls.room = Room.objects.create(
+            name="room", chat_type=ChatType.GROUP, creator=cls.alice
+        )
+        cls.room.participants.add(cls.alice, cls.bob, cls.carol)
+
+    def send(self, sender):
+        return Message.objects.create(room=self.room, sender=sender, content="hi")
+
+    def assertStatus(self, message, status):
+        message = Message.objects.get(pk=message.pk)
+        self.assertEqual(message.get_status_display(), status)
+        (prefetched,) = Message.prefetch_statuses([Message.objects.get(pk=message.pk)])
+        self.assertEqual(prefetched.get_status_display(), status)
+
+    def test_lowest_recipient_decides(self):
+        message = self.send(self.alice)
+        self.assertStatus(message, MessageStatus.SENT)
+
+        message.mark_as_read(self.bob)
+        self.assertStatus(message, MessageStatus.SENT)
+        message.mark_as_delivered(self.carol)
+        self.assertStatus(message, MessageStatus.DELIVERED)
+        message.mark_as_read(self.carol)
+        self.assertStatus(message, MessageStatus.READ)
+
+    def test_sender_watermark_is_ignored(self):
+        message = self.send(self.alice)
+        message.mark_as_read(self.bob)
+        message.mark_as_read(self.carol)
+        # Alice never acknowledged anything, yet her message is read
+        self.assertEqual(
+            RoomWatermark.objects.get(room=self.room, user=self.alice).last_read_id, 0
+        )
+        self.assertStatus(message, MessageStatus.READ)
+
+    def test_recipient_status(self):
+        message = self.send(self.bob)
+        message.mark_as_read(self.carol)
+        # Alice has not received Bob's message, whatever Bob saw
+        self.assertStatus(message, MessageStatus.SENT)
+        self.assertEqual(message.get_status_for_user(self.carol), MessageStatus.READ)
+        self.assertEqual(message.get_status_for_user(self.alice), MessageStatus.SENT)
+
+    def test_room_without_recipients(self):
+        self.room.participants.remove(self.bob, self.carol)
+        self.assertStatus(self.send(self.alice), MessageStatus.SENT)
+
+    def test_floor_status(self):
+        floor = {"total": 2, "delivered": 10, "read": 5}
+        self.assertEqual(RoomWatermark.floor_status(floor, 5), MessageStatus.READ)
+        self.assertEqual(RoomWatermark.floor_status(floor, 6), MessageStatus.DELIVERED)
+        self.assertEqual(RoomWatermark.floor_status(floor, 11), MessageStatus.SENT)
+        empty = {"total": 0, "delivered": None, "read": None}
+        self.assertEqual(RoomWatermark.floor_status(empty, 1), MessageStatus.SENT)
@@ -7,6 +7,23 @@ app_name = "chat"
 urlpatterns = [
     path("", views.RoomListView.as_view(), name="index"),
     path("room/<int:pk>/", views.RoomDetailView.as_view(), name="room"),
+    path(
+        "room/<int:pk>/messages/",
+        views.MessageHistoryView.as_view(),
+        name="history",
+    ),
+    path(
+        "room/<int:pk>/events/",
+        views.RoomEventsView.as_view(),
+        name="events",
+    ),
+    path(
+        "room/<int:pk>/export/",
+        views.RoomExportView.as_view(),
+        name="export",
+    ),
+    path("search/", views.MessageSearchView.as_view(), name="search"),
+    path("metrics", views.MetricsView.as_view(), name="metrics"),
     path(
         "create/private/",
         views.CreatePrivateChatView.as_view(),
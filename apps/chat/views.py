@@ -1,112 +1,316 @@
-from django.contrib.auth.mixins import LoginRequiredMixin
+import hmac
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import get_user_model
+from django.contrib.auth.mixins import AccessMixin, LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
-from django.db.models import Count, Max, Prefetch, Q
-from django.shortcuts import get_object_or_404, redirect
-from django.urls import reverse_lazy
-from django.views.generic import CreateView, DetailView, ListView
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import redirect, render
+from django.views.generic import View
 
+from . import history, metrics, search
+from .budgets import QueryBudget
 from .forms import GroupChatForm, PrivateChatForm
-from .models import Message, MessageReceipt, MessageStatus, Room
+from .models import Message, Room, RoomEvent, RoomWatermark
+
+User = get_user_model()
+
+
+def rooms_for_user(user):
+    """The user's rooms, most recently active first, with unread counts.
+
+    Reads the denormalized ``Room.last_message``/``last_activity`` columns so
+    the sidebar and room list never aggregate over the messages table.
+    """
+    delivered_upto = RoomWatermark.objects.filter(
+        room=OuterRef("pk"), user=user
+    ).values("last_delivered_id")[:1]
+    unread = (
+        Message.objects.filter(
+            room=OuterRef("pk"),
+            id__gt=Coalesce(Subquery(delivered_upto), 0),
+        )
+        .exclude(sender=user)
+        .order_by()
+        .values("room")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    return (
+        Room.objects.filter(participants=user)
+        .annotate(unread_count=Coalesce(Subquery(unread), 0))
+        .select_related("last_message")
+        .prefetch_related("participants")
+        .order_by(F("last_activity").desc(nulls_last=True), "-id")
+    )
+
+
+def chat_partners(user):
+    """Users the user can start a chat with"""
+    return User.objects.exclude(id=user.id).order_by("username")
+
 
+def chat_forms(user, partners):
+    """
+    The new-chat forms, with their choices taken from the already loaded
+    `partners` so that rendering them does not query the database
+    """
+    choices = [(partner.pk, str(partner)) for partner in partners]
+    private_chat_form = PrivateChatForm(user=user)
+    private_chat_form.fields["recipient"].choices = [("", "---------"), *choices]
+    group_chat_form = GroupChatForm(user=user)
+    group_chat_form.fields["participants"].choices = choices
+    return {"private_chat_form": private_chat_form, "group_chat_form": group_chat_form}
+
+
+class AsyncLoginRequiredMixin(AccessMixin):
+    """LoginRequiredMixin for async views; resolves request.user up front"""
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        if not request.user.is_authenticated:
+            return self.handle_no_permission()
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class RoomListView(AsyncLoginRequiredMixin, View):
+    """
+    The user's rooms and the new-chat forms. The queries run one after the
+    other in a single sync_to_async call: async ORM calls share the one
+    thread-sensitive executor, so gathering them would not run them in
+    parallel, only add thread hops.
+    """
 
-class RoomListView(LoginRequiredMixin, ListView):
-    model = Room
     template_name = "chat/index.html"
-    context_object_name = "rooms"
+    query_budget = QueryBudget(queries=5)
 
-    def get_queryset(self):
-        return (
-            Room.objects.filter(participants=self.request.user)
-            .annotate(
-                last_message_time=Max("messages__dtm_created"),
-                unread_count=Count(
-                    "messages",
-                    filter=Q(
-                        messages__receipts__user=self.request.user,
-                        messages__receipts__status=MessageStatus.SENT,
-                    ),
-                ),
-                participant_count=Count("participants", distinct=True),
-            )
-            .prefetch_related(
-                Prefetch(
-                    "messages",
-                    queryset=Message.objects.order_by("-dtm_created"),
-                    to_attr="recent_messages",
-                ),
-                "participants",
-            )
-            .order_by("-last_message_time")
+    async def get(self, request):
+        rooms, partners = await sync_to_async(self.load)(request.user)
+        return render(
+            request,
+            self.template_name,
+            {"rooms": rooms, **chat_forms(request.user, partners)},
         )
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context["private_chat_form"] = PrivateChatForm(user=self.request.user)
-        context["group_chat_form"] = GroupChatForm(user=self.request.user)
-        return context
+    def load(self, user):
+        return list(rooms_for_user(user)), list(chat_partners(user))
 
 
-class CreatePrivateChatView(LoginRequiredMixin, CreateView):
-    model = Room
-    form_class = PrivateChatForm
-    success_url = reverse_lazy("chat:index")
+class CreateChatView(AsyncLoginRequiredMixin, View):
+    """Handle a new-chat form posted from the room list or a room"""
+
+    form_class = None
+    http_method_names = ["post"]
 
-    def get_form_kwargs(self):
-        kwargs = super().get_form_kwargs()
-        kwargs["user"] = self.request.user
-        return kwargs
+    async def post(self, request):
+        if not await sync_to_async(self.save_form)(request):
+            messages.error(request, "The chat could not be created.")
+        return redirect("chat:index")
 
+    def save_form(self, request):
+        # Validation and the room with its participants need the sync ORM
+        form = self.form_class(request.POST, user=request.user)
+        if not form.is_valid():
+            return False
+        form.save()
+        return True
 
-class CreateGroupChatView(LoginRequiredMixin, CreateView):
-    model = Room
+
+class CreatePrivateChatView(CreateChatView):
+    form_class = PrivateChatForm
+
+
+class CreateGroupChatView(CreateChatView):
     form_class = GroupChatForm
-    success_url = reverse_lazy("chat:index")
 
-    def get_form_kwargs(self):
-        kwargs = super().get_form_kwargs()
-        kwargs["user"] = self.request.user
-        return kwargs
 
+class RoomDetailView(AsyncLoginRequiredMixin, View):
+    """
+    A room with its newest messages, the sidebar and the new-chat forms,
+    loaded in one sync_to_async call like RoomListView's
+    """
 
-class RoomDetailView(LoginRequiredMixin, DetailView):
-    model = Room
     template_name = "chat/room.html"
+    query_budget = QueryBudget(queries=9)
+
+    async def get(self, request, pk):
+        room, (messages_page, has_more), chat_rooms, partners = await sync_to_async(
+            self.load
+        )(request.user, pk)
+
+        return render(
+            request,
+            self.template_name,
+            {
+                "room": room,
+                "messages": messages_page,
+                "history_cursor": (
+                    history.encode_cursor(messages_page[0]) if messages_page else ""
+                ),
+                "history_has_more": has_more,
+                "chat_rooms": chat_rooms,
+                **chat_forms(request.user, partners),
+            },
+        )
 
-    def get_object(self):
-        room = super().get_object()
-        if self.request.user not in room.participants.all():
+    def load(self, user, pk):
+        room = (
+            Room.objects.select_related("creator")
+            .prefetch_related("participants")
+            .filter(pk=pk)
+            .first()
+        )
+        if room is None:
+            raise Http404("No room found matching the query")
+        if user not in room.participants.all():
             raise PermissionDenied
-        return room
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        room = self.get_object()
-
-        # Get messages with their receipts, ordered by dtm_created ascending
-        messages = (
-            Message.objects.filter(room=room)
-            .prefetch_related(
-                Prefetch(
-                    "receipts",
-                    queryset=MessageReceipt.objects.filter(user=self.request.user),
-                )
-            )
-            .order_by("dtm_created")[:100]
+        # Newest page of messages; older pages are loaded from MessageHistoryView
+        messages_page, has_more = history.get_page(room.id)
+        return (
+            room,
+            (Message.prefetch_statuses(messages_page), has_more),
+            list(rooms_for_user(user)),
+            list(chat_partners(user)),
         )
 
-        # Get all chat rooms for the sidebar
-        chat_rooms = (
-            Room.objects.filter(participants=self.request.user)
-            .annotate(last_message_time=Max("messages__dtm_created"))
-            .order_by("-last_message_time")
+
+class MessageHistoryView(LoginRequiredMixin, View):
+    """JSON pages of a room's messages, addressed by before/after cursors"""
+
+    query_budget = QueryBudget(queries=5)
+
+    def get(self, request, pk):
+        if not Room.objects.filter(pk=pk, participants=request.user).exists():
+            raise PermissionDenied
+
+        try:
+            limit = min(
+                int(request.GET.get("limit", history.PAGE_SIZE)), history.MAX_PAGE_SIZE
+            )
+            messages, has_more = history.get_page(
+                pk,
+                before=request.GET.get("before"),
+                after=request.GET.get("after"),
+                limit=max(limit, 1),
+            )
+        except ValueError:
+            return JsonResponse({"error": "Invalid cursor or limit"}, status=400)
+
+        return JsonResponse(
+            history.serialize_page(pk, request.user, messages, has_more)
         )
 
-        context.update(
+
+class RoomEventsView(LoginRequiredMixin, View):
+    """JSON range of a room's event log following the `after` sequence number"""
+
+    query_budget = QueryBudget(queries=5)
+
+    def get(self, request, pk):
+        if not Room.objects.filter(pk=pk, participants=request.user).exists():
+            raise PermissionDenied
+
+        try:
+            after = max(int(request.GET.get("after", 0)), 0)
+            limit = min(max(int(request.GET.get("limit", 100)), 1), 1000)
+        except ValueError:
+            return JsonResponse({"error": "Invalid after or limit"}, status=400)
+
+        events, last_seq, reset = RoomEvent.read(pk, after=after, limit=limit)
+        return JsonResponse(
             {
-                "messages": messages,
-                "chat_rooms": chat_rooms,
-                "private_chat_form": PrivateChatForm(user=self.request.user),
-                "group_chat_form": GroupChatForm(user=self.request.user),
+                "events": [event.as_dict() for event in events],
+                "last_seq": last_seq,
+                "has_more": bool(events) and events[-1].seq < last_seq,
+                "reset": reset,
             }
         )
-        return context
+
+
+class RoomExportView(AsyncLoginRequiredMixin, View):
+    """A room's whole history, archived and live, as JSON lines"""
+
+    # Messages read from the database or archive per chunk of the response
+    batch_size = 1000
+
+    async def get(self, request, pk):
+        if not await Room.objects.filter(pk=pk, participants=request.user).aexists():
+            raise PermissionDenied
+        return StreamingHttpResponse(
+            self.lines(pk),
+            content_type="application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="room-{pk}.jsonl"'},
+        )
+
+    async def lines(self, room_id):
+        # Keyset batches, so no cursor is held open between chunks
+        key = None
+        while True:
+            page, has_more = await sync_to_async(history.read_after)(
+                room_id, key, self.batch_size
+            )
+            yield "".join(
+                json.dumps(history.serialize_message(message)) + "\n"
+                for message in page
+            )
+            if not has_more:
+                return
+            key = (page[-1].dtm_created, page[-1].id)
+
+
+class MessageSearchView(LoginRequiredMixin, View):
+    """JSON full-text search over the messages of the user's rooms"""
+
+    query_budget = QueryBudget(queries=4)
+
+    def get(self, request):
+        query = request.GET.get("q", "")
+        if not search.query_terms(query):
+            return JsonResponse({"error": "Missing search words"}, status=400)
+        try:
+            room_id = request.GET.get("room")
+            before = request.GET.get("before")
+            limit = min(
+                int(request.GET.get("limit", search.PAGE_SIZE)), search.MAX_PAGE_SIZE
+            )
+            hits, has_more = search.search(
+                request.user,
+                query,
+                room_id=int(room_id) if room_id else None,
+                before=int(before) if before else None,
+                limit=max(limit, 1),
+            )
+        except ValueError:
+            return JsonResponse({"error": "Invalid room, before or limit"}, status=400)
+
+        return JsonResponse(search.serialize_results(hits, has_more))
+
+
+class MetricsView(View):
+    """
+    Prometheus metrics of this process, for requests carrying the
+    CHAT_METRICS_TOKEN as a bearer token and for staff
+    """
+
+    async def get(self, request):
+        if not await self.has_access(request):
+            raise PermissionDenied
+        # Async so that the metrics are read on the event loop updating them
+        return HttpResponse(
+            metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
+
+    async def has_access(self, request):
+        token = getattr(settings, "CHAT_METRICS_TOKEN", "")
+        authorization = request.headers.get("Authorization", "")
+        if token and hmac.compare_digest(
+            authorization.encode(), f"Bearer {token}".encode()
+        ):
+            return True
+        user = await request.auser()
+        return user.is_active and user.is_staff
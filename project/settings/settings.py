@@ -60,6 +60,7 @@ MIDDLEWARE = [
     "django.middleware.csrf.CsrfViewMiddleware",
     "debug_toolbar.middleware.DebugToolbarMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "apps.chat.profiling.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "htmlmin.middleware.HtmlMinifyMiddleware",
@@ -229,4 +230,55 @@ SITE_TITLE = os.getenv("SITE_TITLE", "Qjango")
 
 ASGI_APPLICATION = "project.asgi.application"
 
-CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": os.getenv(
+            "CHANNEL_LAYER_BACKEND", "apps.chat.layers.ChatChannelLayer"
+        ),
+        "CONFIG": {
+            "capacity": int(os.getenv("CHANNEL_LAYER_CAPACITY", "100")),
+            "overflow": os.getenv("CHANNEL_LAYER_OVERFLOW", "drop_oldest"),
+        },
+    }
+}
+
+# Private socket directory shared by the workers of IPCChannelLayer
+if os.getenv("CHANNEL_LAYER_PATH"):
+    CHANNEL_LAYERS["default"]["CONFIG"]["path"] = os.getenv("CHANNEL_LAYER_PATH")
+
+CHAT_PRESENCE = {
+    "BACKEND": os.getenv(
+        "CHAT_PRESENCE_BACKEND", "apps.chat.presence.InMemoryPresence"
+    ),
+    "TTL": int(os.getenv("CHAT_PRESENCE_TTL", "60")),
+}
+
+# Seconds between coalesced delivery/read status broadcasts per room
+CHAT_RECEIPT_INTERVAL = float(os.getenv("CHAT_RECEIPT_INTERVAL", "0.25"))
+
+# Days room events are kept for incremental sync before compaction
+CHAT_EVENT_RETENTION_DAYS = int(os.getenv("CHAT_EVENT_RETENTION_DAYS", "30"))
+
+CHAT_PERSISTENCE = {
+    "BACKEND": os.getenv(
+        "CHAT_PERSISTENCE_BACKEND", "apps.chat.persistence.DirectPersistence"
+    ),
+    "FLUSH_INTERVAL": float(os.getenv("CHAT_PERSISTENCE_FLUSH_INTERVAL", "0.005")),
+    "MAX_BATCH": int(os.getenv("CHAT_PERSISTENCE_MAX_BATCH", "100")),
+}
+
+# Cold storage of old messages, see apps/chat/archive.py; every process
+# serving the history must see the same directory
+CHAT_ARCHIVE = {
+    "DIR": os.getenv("CHAT_ARCHIVE_DIR", os.path.join(BASE_DIR, "archive")),
+    "AFTER_DAYS": int(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "180")),
+}
+
+# Where sampled profiles are written; profiling is off without it
+CHAT_PROFILING = {
+    "DIR": os.getenv("CHAT_PROFILING_DIR", ""),
+    "INTERVAL": float(os.getenv("CHAT_PROFILING_INTERVAL", "0.005")),
+}
+
+# Bearer token for scraping /metrics; without it only staff can read them
+CHAT_METRICS_TOKEN = os.getenv("CHAT_METRICS_TOKEN", "")